@@ -4,15 +4,925 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
+import ast
 import logging
 import json
 import os
+import threading
+import time
+import configparser
+import bisect
+import mmap
+import re
+import statistics
 from collections import deque
-from typing import Dict, Any, Optional, Tuple, Deque
+from typing import Dict, Any, Optional, Tuple, Deque, Callable, Union
+
+# Placeholders in the slicer start G-code marking the resume setup section
+PLR_SETUP_PLACEHOLDER = b";;;;; PLR_RESUME - INITIAL PRINTER SETUP STARTS ;;;;;"
+PLR_GCODE_PLACEHOLDER = b";;;;; PLR_RESUME - PRINT GCODE STARTS ;;;;;"
+PLR_PLACEHOLDER_RE = re.compile(
+	re.escape(PLR_SETUP_PLACEHOLDER) + b'|' + re.escape(PLR_GCODE_PLACEHOLDER))
+RESUME_COPY_CHUNK = 1024 * 1024
+# Two-sided Student t critical values for 1-10 degrees of freedom
+T_CRITICAL = {
+	0.90: (6.314, 2.920, 2.353, 2.132, 2.015, 1.943, 1.895, 1.860, 1.833, 1.812),
+	0.95: (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228),
+	0.99: (63.657, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499, 3.355, 3.250, 3.169),
+}
+# Samples further than this many robust standard deviations from the median are outliers
+OUTLIER_MAD_SIGMAS = 3.0
+# Start of slicer metadata blocks (thumbnails, config dumps), the end
+# marker is the same line with begin/START replaced by end/END
+METADATA_BLOCK_RE = re.compile(
+	rb'^;[ \t]*(thumbnail(?:_[A-Za-z]+)? begin|THUMBNAIL_BLOCK_START|CONFIG_BLOCK_START'
+	rb'|[a-z_]+_config = begin)', re.M)
 
 def load_config(config):
 	return PowerLossRecovery(config)
 
+def map_file(infile) -> Union[mmap.mmap, bytes]:
+	"""Read-only memory map of a binary file (empty files map to b'')"""
+	if os.fstat(infile.fileno()).st_size == 0:
+		return b''
+	return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+def line_end(data, offset: int) -> int:
+	"""Offset just past the line containing offset"""
+	idx = data.find(b'\n', offset)
+	return len(data) if idx < 0 else idx + 1
+
+def is_comment_block(segment: bytes) -> bool:
+	"""True if all lines in segment are empty or comments"""
+	for line in segment.split(b'\n'):
+		line = line.strip()
+		if line and not line.startswith(b';'):
+			return False
+	return True
+
+def confidence_half_width(values: list, confidence: float) -> float:
+	"""Half width of the confidence interval of the mean of values"""
+	n = len(values)
+	if n < 2:
+		return float('inf')
+	t = T_CRITICAL[confidence][min(n - 1, 10) - 1]
+	return t * statistics.stdev(values) / n ** .5
+
+def find_outliers(values: list, floor: float) -> list:
+	"""
+	Indexes of values further than OUTLIER_MAD_SIGMAS robust standard
+	deviations (from the median absolute deviation) from the median, but
+	never closer than floor.
+	"""
+	if len(values) < 3:
+		return []
+	median = statistics.median(values)
+	mad = statistics.median([abs(v - median) for v in values])
+	limit = max(OUTLIER_MAD_SIGMAS * 1.4826 * mad, floor)
+	return [i for i, v in enumerate(values) if abs(v - median) > limit]
+
+def sample_statistics(values: list) -> Dict[str, float]:
+	median = statistics.median(values)
+	return {
+		'mean': round(statistics.mean(values), 5),
+		'median': round(median, 5),
+		'stdev': round(statistics.stdev(values), 5) if len(values) > 1 else 0.,
+		'mad': round(statistics.median([abs(v - median) for v in values]), 5),
+		'range': round(max(values) - min(values), 5),
+	}
+
+def find_placeholders(data, start: int, end: int) -> Tuple[Optional[int], Optional[int]]:
+	"""
+	Find the setup and print G-code placeholders in data[start:end] in a
+	single pass. Returns the offsets just past both placeholder lines
+	(None if not found).
+	"""
+	setup_end = None
+	for m in PLR_PLACEHOLDER_RE.finditer(data, start, end):
+		if setup_end is None:
+			if m.group() == PLR_SETUP_PLACEHOLDER:
+				setup_end = line_end(data, m.start())
+		elif m.group() == PLR_GCODE_PLACEHOLDER:
+			return setup_end, line_end(data, m.start())
+	return setup_end, None
+
+def find_metadata_blocks(data, start: int, end: int) -> list:
+	"""
+	Byte ranges (start, end) of complete slicer metadata blocks in
+	data[start:end]. Unterminated blocks are not reported.
+	"""
+	blocks = []
+	pos = start
+	while True:
+		m = METADATA_BLOCK_RE.search(data, pos, end)
+		if m is None:
+			return blocks
+		marker = m.group(1)
+		end_marker = marker.replace(b'begin', b'end').replace(b'_START', b'_END')
+		idx = data.find(end_marker, m.end(), end)
+		if idx < 0:
+			return blocks
+		block_end = min(line_end(data, idx), end)
+		blocks.append((m.start(), block_end))
+		pos = block_end
+
+def skip_ranges(start: int, end: int, ranges: list) -> list:
+	"""The parts of [start, end) not covered by the sorted ranges"""
+	segments = []
+	for range_start, range_end in ranges:
+		if range_start > start:
+			segments.append((start, range_start))
+		start = max(start, range_end)
+	if end > start:
+		segments.append((start, end))
+	return segments
+
+def copy_file_range(infile, outfile, offset: int, count: int):
+	"""
+	Copy count bytes starting at offset from infile to the current position
+	of the unbuffered outfile, using sendfile when the platform supports it.
+	"""
+	in_fd = infile.fileno()
+	out_fd = outfile.fileno()
+	if hasattr(os, 'sendfile'):
+		try:
+			while count > 0:
+				sent = os.sendfile(out_fd, in_fd, offset, min(count, 0x7ffff000))
+				if sent <= 0:
+					break
+				offset += sent
+				count -= sent
+		except OSError:
+			# Fall back to read/write below for the remaining bytes
+			pass
+	while count > 0:
+		data = os.pread(in_fd, min(count, RESUME_COPY_CHUNK), offset)
+		if not data:
+			break
+		write_all(outfile, data)
+		offset += len(data)
+		count -= len(data)
+
+def write_all(outfile, data: bytes):
+	"""Write data to an unbuffered file, handling short writes"""
+	view = memoryview(data)
+	while view:
+		written = outfile.write(view)
+		view = view[written:]
+
+def parse_gcode_param(line: bytes, param: bytes) -> Optional[float]:
+	"""Return the numeric value of a G-code parameter (e.g. b'S') or None"""
+	line = line.split(b';', 1)[0]
+	for word in line.split()[1:]:
+		if word[:1].upper() == param:
+			try:
+				return float(word[1:])
+			except ValueError:
+				return None
+	return None
+
+class GCodeModalState:
+	"""
+	Modal printer state reconstructed from a G-code prefix: positioning and
+	extrusion modes, E position, feedrate, tool, fan, temperatures, firmware
+	retraction and the exclude_object object being printed.
+	"""
+	FIELDS = ('tool', 'fan', 'hotend_temp', 'bed_temp', 'absolute_coords',
+			  'absolute_extrude', 'retracted', 'current_object')
+
+	# Layer markers and modal commands. Moves (G0/G1, the bulk of a file)
+	# are deliberately not matched, their E/F values are found by a bounded
+	# backwards search instead.
+	MODAL_RE = re.compile(
+		rb'^(?:(;LAYER_CHANGE)|;LAYER:(-?\d+)|;Z:([-+\d.]+)'
+		rb'|(G90|G91|M82|M83|G10|G11|M104|M109|M140|M190|M106|M107)(?![\d.])([^\n;]*)'
+		rb'|T(\d+)|EXCLUDE_OBJECT_(START|END)([^\n;]*))', re.M)
+	MOTION_RE = re.compile(rb'^(?:G[0-3]|G92)(?![\d.])([^\n;]*)', re.M)
+	OBJECT_NAME_RE = re.compile(rb'NAME=("[^"]*"|\S+)', re.I)
+	MOTION_WINDOW = 64 * 1024
+
+	def __init__(self):
+		self.tool = 0
+		self.fan = 0.
+		self.hotend_temp = 0.
+		self.bed_temp = 0.
+		self.absolute_coords = True
+		self.absolute_extrude = True
+		self.retracted = False
+		self.current_object: Optional[str] = None
+		self.e_position: Optional[float] = None
+		self.feedrate: Optional[float] = None
+
+	def snapshot(self) -> list:
+		return [getattr(self, name) for name in self.FIELDS]
+
+	@classmethod
+	def from_snapshot(cls, values) -> 'GCodeModalState':
+		state = cls()
+		for name, value in zip(cls.FIELDS, values):
+			setattr(state, name, value)
+		return state
+
+	def to_dict(self) -> Dict[str, Any]:
+		result = dict(zip(self.FIELDS, self.snapshot()))
+		result['e_position'] = self.e_position
+		result['feedrate'] = self.feedrate
+		return result
+
+	def apply(self, cmd: bytes, args: bytes):
+		"""Update the state from one modal command"""
+		if cmd == b'G90':
+			self.absolute_coords = True
+		elif cmd == b'G91':
+			self.absolute_coords = False
+		elif cmd == b'M82':
+			self.absolute_extrude = True
+		elif cmd == b'M83':
+			self.absolute_extrude = False
+		elif cmd == b'G10':
+			self.retracted = True
+		elif cmd == b'G11':
+			self.retracted = False
+		elif cmd in (b'M104', b'M109'):
+			value = parse_gcode_param(cmd + args, b'S')
+			if value is not None:
+				self.hotend_temp = value
+		elif cmd in (b'M140', b'M190'):
+			value = parse_gcode_param(cmd + args, b'S')
+			if value is not None:
+				self.bed_temp = value
+		elif cmd in (b'M106', b'M107'):
+			# P selects other fans (aux, chamber), only P0 is the part fan
+			index = parse_gcode_param(cmd + args, b'P')
+			if index is not None and index != 0:
+				return
+			if cmd == b'M107':
+				self.fan = 0.
+				return
+			value = parse_gcode_param(cmd + args, b'S')
+			self.fan = 255. if value is None else value
+
+	@classmethod
+	def parse_object_name(cls, args: bytes) -> Optional[str]:
+		m = cls.OBJECT_NAME_RE.search(args)
+		return m.group(1).strip(b'"').decode('utf-8', errors='replace') if m else None
+
+	def apply_object(self, kind: bytes, args: bytes):
+		if kind == b'END':
+			self.current_object = None
+			return
+		self.current_object = self.parse_object_name(args)
+
+	def replay(self, data, start: int, end: int):
+		"""Apply all modal commands in data[start:end]"""
+		for m in self.MODAL_RE.finditer(data, start, end):
+			_, _, _, cmd, args, tnum, obj_kind, obj_args = m.groups()
+			if cmd is not None:
+				self.apply(cmd, args)
+			elif tnum is not None:
+				self.tool = int(tnum)
+			elif obj_kind is not None:
+				self.apply_object(obj_kind, obj_args)
+
+	def find_motion_state(self, data, start: int, end: int):
+		"""
+		Find the last E position (G0-G3/G92) and feedrate before end by
+		searching backwards in growing windows.
+		"""
+		need_e = self.absolute_extrude
+		window = self.MOTION_WINDOW
+		window_end = end
+		while window_end > start and ((need_e and self.e_position is None) or self.feedrate is None):
+			window_start = max(start, window_end - window)
+			window_start = data.rfind(b'\n', start, window_start) + 1 if window_start > start else start
+			last_e = last_f = None
+			for m in self.MOTION_RE.finditer(data, window_start, window_end):
+				args = m.group(1)
+				if b'E' in args or b'e' in args:
+					last_e = m
+				if b'F' in args or b'f' in args:
+					last_f = m
+			if need_e and self.e_position is None and last_e is not None:
+				self.e_position = parse_gcode_param(b'G ' + last_e.group(1), b'E')
+			if self.feedrate is None and last_f is not None:
+				self.feedrate = parse_gcode_param(b'G ' + last_f.group(1), b'F')
+			window_end = window_start
+			window *= 2
+
+	@classmethod
+	def last_e_position(cls, data, start: int, end: int) -> Optional[float]:
+		"""E value of the last G0-G3/G92 move with E in data[start:end]"""
+		last_e = None
+		for m in cls.MOTION_RE.finditer(data, start, end):
+			args = m.group(1)
+			if b'E' in args or b'e' in args:
+				last_e = args
+		if last_e is None:
+			return None
+		return parse_gcode_param(b'G ' + last_e, b'E')
+
+	def restore_gcode(self) -> list:
+		"""G-code lines restoring this state after the restart G-code"""
+		lines = []
+		if self.hotend_temp:
+			lines.append(f"M104 S{self.hotend_temp:g}")
+		if self.bed_temp:
+			lines.append(f"M140 S{self.bed_temp:g}")
+		if self.tool:
+			lines.append(f"T{self.tool}")
+		if self.fan:
+			lines.append(f"M106 S{self.fan:g}")
+		else:
+			lines.append("M107")
+		if self.absolute_extrude:
+			lines.append("M82")
+			if self.e_position is not None:
+				lines.append(f"G92 E{self.e_position:.5f}")
+		else:
+			lines.append("M83")
+		if self.retracted:
+			lines.append("G10")
+		if self.current_object:
+			lines.append(f"EXCLUDE_OBJECT_START NAME={self.current_object}")
+		if self.feedrate:
+			lines.append(f"G1 F{self.feedrate:g}")
+		lines.append("G90" if self.absolute_coords else "G91")
+		return lines
+
+class ObjectRanges:
+	"""
+	Byte ranges of the EXCLUDE_OBJECT_START/END regions of each object,
+	keyed by the upper case object name as used by exclude_object.
+	"""
+	OBJECT_RE = re.compile(rb'^EXCLUDE_OBJECT_(START|END)([^\n;]*)', re.M)
+
+	def __init__(self, ranges: Optional[Dict[str, list]] = None):
+		# Flat [start, end, start, end, ...] lists
+		self.ranges: Dict[str, list] = ranges if ranges is not None else {}
+		self._open: Optional[Tuple[str, int]] = None
+
+	@classmethod
+	def scan(cls, data, start: int, end: int) -> 'ObjectRanges':
+		objects = cls()
+		for m in cls.OBJECT_RE.finditer(data, start, end):
+			objects.add_marker(data, m.start(), m.group(1), m.group(2))
+		return objects
+
+	def add_marker(self, data, offset: int, kind: bytes, args: bytes):
+		"""Record an EXCLUDE_OBJECT_START/END line starting at offset"""
+		if kind == b'START':
+			# A START without END closes the previous object
+			self._close(offset)
+			name = GCodeModalState.parse_object_name(args)
+			if name:
+				self._open = (name.upper(), offset)
+		else:
+			self._close(line_end(data, offset))
+
+	def _close(self, offset: int):
+		if self._open is not None:
+			name, start = self._open
+			self.ranges.setdefault(name, []).extend((start, offset))
+			self._open = None
+
+	def select(self, names, start: int) -> list:
+		"""Sorted (start, end) ranges of the named objects ending after start"""
+		selected = []
+		for name in names:
+			flat = self.ranges.get(name.upper(), [])
+			for i in range(0, len(flat), 2):
+				if flat[i + 1] > start:
+					selected.append((flat[i], flat[i + 1]))
+		selected.sort()
+		return selected
+
+class GCodeLayerIndex:
+	"""
+	Compact index of the layer changes in a G-code file: byte offset, layer
+	number, Z and the modal state (tool, fan, temperatures, modes) in
+	effect before each layer, plus the byte ranges of each exclude_object
+	object. Stored as a hidden sidecar next to the G-code file.
+	"""
+	VERSION = 3
+	# Max distance between ;LAYER_CHANGE and its ;Z: comment
+	LAYER_Z_WINDOW = 1024
+
+	def __init__(self, file_size: int = 0, file_mtime: int = 0):
+		self.file_size = file_size
+		self.file_mtime = file_mtime
+		self.setup_end: Optional[int] = None
+		self.gcode_start_end: Optional[int] = None
+		self.offsets = []
+		self.layers = []
+		self.z = []
+		self.states = []
+		self.objects = ObjectRanges()
+
+	@staticmethod
+	def sidecar_path(gcode_path: str) -> str:
+		dirname, basename = os.path.split(gcode_path)
+		return os.path.join(dirname, f".{basename}.plridx")
+
+	@classmethod
+	def build(cls, gcode_path: str) -> 'GCodeLayerIndex':
+		st = os.stat(gcode_path)
+		index = cls(st.st_size, st.st_mtime_ns)
+		with open(gcode_path, 'rb') as f:
+			data = map_file(f)
+			try:
+				index._scan(data)
+			finally:
+				if isinstance(data, mmap.mmap):
+					data.close()
+		return index
+
+	def _scan(self, data):
+		self.setup_end, self.gcode_start_end = find_placeholders(data, 0, len(data))
+		state = GCodeModalState()
+		layer_change_end = None
+		for m in GCodeModalState.MODAL_RE.finditer(data):
+			layer_change, layer_num, z, cmd, args, tnum, obj_kind, obj_args = m.groups()
+			if layer_change is not None or layer_num is not None:
+				layer = len(self.layers) if layer_num is None else int(layer_num)
+				self.offsets.append(m.start())
+				self.layers.append(layer)
+				self.z.append(None)
+				self.states.append(state.snapshot())
+				layer_change_end = m.end() if layer_change is not None else None
+			elif z is not None:
+				# Only a ;Z: inside the comment block of a ;LAYER_CHANGE counts
+				if (layer_change_end is not None
+						and m.start() - layer_change_end <= self.LAYER_Z_WINDOW
+						and is_comment_block(data[layer_change_end:m.start()])):
+					try:
+						self.z[-1] = float(z)
+					except ValueError:
+						pass
+				layer_change_end = None
+			elif cmd is not None:
+				state.apply(cmd, args)
+			elif tnum is not None:
+				state.tool = int(tnum)
+			elif obj_kind is not None:
+				state.apply_object(obj_kind, obj_args)
+				self.objects.add_marker(data, m.start(), obj_kind, obj_args)
+
+	def find(self, position: int) -> Optional[int]:
+		"""Index of the last layer starting at or before position"""
+		i = bisect.bisect_right(self.offsets, position) - 1
+		return i if i >= 0 else None
+
+	def last_z_before(self, position: int) -> Optional[float]:
+		i = self.find(position)
+		while i is not None and i >= 0:
+			if self.z[i] is not None:
+				return self.z[i]
+			i -= 1
+		return None
+
+	def is_valid_for(self, gcode_path: str) -> bool:
+		try:
+			st = os.stat(gcode_path)
+		except OSError:
+			return False
+		return st.st_size == self.file_size and st.st_mtime_ns == self.file_mtime
+
+	def save(self, path: str):
+		data = {
+			'version': self.VERSION,
+			'file_size': self.file_size,
+			'file_mtime': self.file_mtime,
+			'setup_end': self.setup_end,
+			'gcode_start_end': self.gcode_start_end,
+			'fields': GCodeModalState.FIELDS,
+			'offsets': self.offsets,
+			'layers': self.layers,
+			'z': self.z,
+			'states': self.states,
+			'objects': self.objects.ranges,
+		}
+		tmp_name = f"{path}.tmp"
+		with open(tmp_name, 'w') as f:
+			json.dump(data, f, separators=(',', ':'))
+		os.replace(tmp_name, path)
+
+	@classmethod
+	def load(cls, path: str) -> Optional['GCodeLayerIndex']:
+		try:
+			with open(path, 'r') as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return None
+		if (data.get('version') != cls.VERSION
+				or tuple(data.get('fields', ())) != GCodeModalState.FIELDS):
+			return None
+		index = cls(data['file_size'], data['file_mtime'])
+		index.setup_end = data.get('setup_end')
+		index.gcode_start_end = data.get('gcode_start_end')
+		for name in ('offsets', 'layers', 'z', 'states'):
+			setattr(index, name, data[name])
+		index.objects = ObjectRanges(data['objects'])
+		return index
+
+	@classmethod
+	def load_for(cls, gcode_path: str) -> Optional['GCodeLayerIndex']:
+		"""Load the sidecar index if it matches the current G-code file"""
+		index = cls.load(cls.sidecar_path(gcode_path))
+		if index is None or not index.is_valid_for(gcode_path):
+			return None
+		return index
+
+class SaveStats:
+	"""Thread safe save counters used for PLR health monitoring"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.save_count = 0
+		self.failure_count = 0
+		self.total_duration = 0.
+		self.max_duration = 0.
+		self.last_duration = 0.
+		self.last_save_time = 0.
+		self.bytes_written = 0
+		# Persisted total including the writes of earlier sessions
+		self.lifetime_bytes_written = 0
+		# (monotonic time, bytes) of the writes within the last hour
+		self.recent_writes: Deque[Tuple[float, int]] = deque()
+
+	def record_save(self, duration: float, nbytes: int):
+		with self.lock:
+			now = time.monotonic()
+			self.save_count += 1
+			self.total_duration += duration
+			self.max_duration = max(self.max_duration, duration)
+			self.last_duration = duration
+			self.last_save_time = time.time()
+			self.bytes_written += nbytes
+			self.lifetime_bytes_written += nbytes
+			self.recent_writes.append((now, nbytes))
+			self._prune(now)
+
+	def record_failure(self):
+		with self.lock:
+			self.failure_count += 1
+
+	def set_lifetime_bytes(self, nbytes: int):
+		with self.lock:
+			self.lifetime_bytes_written = nbytes
+
+	def get_lifetime_bytes(self) -> int:
+		with self.lock:
+			return self.lifetime_bytes_written
+
+	def _prune(self, now):
+		while self.recent_writes and now - self.recent_writes[0][0] > 3600.:
+			self.recent_writes.popleft()
+
+	def get_stats(self) -> Dict[str, Any]:
+		with self.lock:
+			self._prune(time.monotonic())
+			avg = self.total_duration / self.save_count if self.save_count else 0.
+			return {
+				'last_save_time': self.last_save_time,
+				'save_count': self.save_count,
+				'failure_count': self.failure_count,
+				'save_duration_avg': round(avg, 4),
+				'save_duration_max': round(self.max_duration, 4),
+				'save_duration_last': round(self.last_duration, 4),
+				'bytes_written': self.bytes_written,
+				'bytes_written_per_hour': sum(n for _, n in self.recent_writes),
+				'lifetime_bytes_written': self.lifetime_bytes_written,
+			}
+
+class WriteBudget:
+	"""
+	Token bucket limiting the number of saves and bytes written per hour.
+	A fraction of the budget is reserved for high value saves.
+	"""
+	def __init__(self, saves_per_hour: int, bytes_per_hour: int, reserve: float):
+		self.saves_per_hour = saves_per_hour
+		self.bytes_per_hour = bytes_per_hour
+		self.reserve = reserve
+		self.save_tokens = float(saves_per_hour)
+		self.byte_tokens = float(bytes_per_hour)
+		self.last_update = None
+
+	def is_limited(self) -> bool:
+		return bool(self.saves_per_hour or self.bytes_per_hour)
+
+	def _refill(self, eventtime):
+		if self.last_update is not None:
+			elapsed = max(0., eventtime - self.last_update)
+			self.save_tokens = min(float(self.saves_per_hour),
+								   self.save_tokens + elapsed * self.saves_per_hour / 3600.)
+			self.byte_tokens = min(float(self.bytes_per_hour),
+								   self.byte_tokens + elapsed * self.bytes_per_hour / 3600.)
+		self.last_update = eventtime
+
+	def allows(self, eventtime, nbytes: int, high_priority: bool) -> bool:
+		self._refill(eventtime)
+		# Normal saves may not dip into the reserved part of the budget
+		floor = 0. if high_priority else self.reserve
+		if self.saves_per_hour and self.save_tokens - 1. < floor * self.saves_per_hour:
+			return False
+		if self.bytes_per_hour and self.byte_tokens - nbytes < floor * self.bytes_per_hour:
+			return False
+		return True
+
+	def consume(self, eventtime, nbytes: int):
+		self._refill(eventtime)
+		if self.saves_per_hour:
+			self.save_tokens = max(0., self.save_tokens - 1.)
+		if self.bytes_per_hour:
+			self.byte_tokens = max(0., self.byte_tokens - nbytes)
+
+	def get_status(self) -> Dict[str, Any]:
+		return {
+			'budget_saves_remaining': round(self.save_tokens, 1) if self.saves_per_hour else None,
+			'budget_bytes_remaining': int(self.byte_tokens) if self.bytes_per_hour else None,
+		}
+
+class StateWriter:
+	"""
+	Persist the save_variables file from a dedicated thread so slow storage
+	never blocks the reactor. Uses a single-slot mailbox: only the latest
+	request is written, older pending requests are dropped.
+	"""
+	def __init__(self, filename: str, snapshot_cb: Callable[[], Dict[str, Any]],
+				 save_stats: SaveStats):
+		self.filename = filename
+		self.snapshot_cb = snapshot_cb
+		self.save_stats = save_stats
+		self.lock = threading.Lock()
+		self.wakeup = threading.Condition(self.lock)
+		self.pending_time: Optional[float] = None
+		self.running = False
+		self.thread = None
+		# Statistics, updated by the writer thread under lock
+		self.write_count = 0
+		self.error_count = 0
+		self.dropped_count = 0
+		self.last_latency = 0.
+		self.max_latency = 0.
+		self.total_latency = 0.
+		self.last_error = None
+
+	def start(self):
+		with self.lock:
+			if self.running:
+				return
+			self.running = True
+		self.thread = threading.Thread(target=self._run, name="plr-state-writer")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		with self.lock:
+			if not self.running:
+				return
+			self.running = False
+			self.wakeup.notify()
+		self.thread.join()
+
+	def submit(self):
+		"""Request a write of the current variables (non-blocking)"""
+		with self.lock:
+			if self.pending_time is not None:
+				self.dropped_count += 1
+			self.pending_time = time.monotonic()
+			self.wakeup.notify()
+
+	def is_pending(self) -> bool:
+		with self.lock:
+			return self.pending_time is not None
+
+	def get_stats(self) -> Dict[str, Any]:
+		with self.lock:
+			avg = self.total_latency / self.write_count if self.write_count else 0.
+			return {
+				'write_count': self.write_count,
+				'error_count': self.error_count,
+				'dropped_count': self.dropped_count,
+				'pending': self.pending_time is not None,
+				'last_latency': round(self.last_latency, 4),
+				'avg_latency': round(avg, 4),
+				'max_latency': round(self.max_latency, 4),
+				'last_error': self.last_error,
+			}
+
+	def _run(self):
+		while True:
+			with self.lock:
+				while self.running and self.pending_time is None:
+					self.wakeup.wait()
+				submit_time = self.pending_time
+				self.pending_time = None
+				if submit_time is None:
+					# Stopped with nothing left to write
+					return
+			try:
+				write_start = time.monotonic()
+				nbytes = write_variables_file(self.filename, self.snapshot_cb())
+				self.save_stats.record_save(time.monotonic() - write_start, nbytes)
+				latency = time.monotonic() - submit_time
+				with self.lock:
+					self.write_count += 1
+					self.last_latency = latency
+					self.total_latency += latency
+					self.max_latency = max(self.max_latency, latency)
+			except Exception as e:
+				logging.exception("PowerLossRecovery: Error writing variables file")
+				self.save_stats.record_failure()
+				with self.lock:
+					self.error_count += 1
+					self.last_error = str(e)
+
+class PhaseTimer:
+	"""
+	Exclusive wall time per phase of a homing sequence. Phases are switched
+	with start() and nested with push()/pop(); time spent in a nested phase
+	is not counted in its parent.
+	"""
+	def __init__(self, clock: Callable[[], float]):
+		self.clock = clock
+		self.times: Dict[str, float] = {}
+		self._stack = []
+		self._last = clock()
+
+	def _charge(self):
+		now = self.clock()
+		if self._stack:
+			name = self._stack[-1]
+			self.times[name] = self.times.get(name, 0.) + now - self._last
+		self._last = now
+
+	def start(self, name: str):
+		self._charge()
+		self._stack[-1:] = [name]
+
+	def push(self, name: str):
+		self._charge()
+		self._stack.append(name)
+
+	def pop(self):
+		self._charge()
+		self._stack.pop()
+
+	def stop(self):
+		self._charge()
+		self._stack.clear()
+
+	def current(self) -> Optional[str]:
+		return self._stack[-1] if self._stack else None
+
+	def total(self) -> float:
+		return sum(self.times.values())
+
+	def report(self) -> str:
+		return ", ".join(f"{name} {duration:.2f}s" for name, duration in self.times.items())
+
+class ProbeTrace:
+	"""
+	Timeline of one PLR_Z_HOME run. Written as a single compact JSON line
+	that tools/plr_trace_analyzer.py reads.
+	"""
+	def __init__(self, clock: Callable[[], float], mode: str, settings: Dict[str, Any]):
+		self.clock = clock
+		self._start = clock()
+		self.record: Dict[str, Any] = {'time': round(time.time(), 3), 'mode': mode,
+									   'settings': settings, 'events': []}
+
+	def add(self, kind: str, **fields):
+		event = {'kind': kind, 't': round(self.clock() - self._start, 4)}
+		for key, value in fields.items():
+			event[key] = round(value, 5) if isinstance(value, float) else value
+		self.record['events'].append(event)
+
+	def write(self, filename: str, **fields):
+		self.record.update(fields)
+		line = json.dumps(self.record, separators=(',', ':'))
+		with open(filename, 'a') as f:
+			f.write(line + '\n')
+
+class CalibrationHistory:
+	"""
+	Bounded history of Z calibration results as compact JSON lines. New
+	results are appended, the file is rewritten with the newest
+	max_entries results once it holds twice as many.
+	"""
+	def __init__(self, filename: str, max_entries: int):
+		self.filename = filename
+		self.max_entries = max_entries
+		self._entries: Optional[list] = None
+		self._lines = 0
+
+	def entries(self) -> list:
+		if self._entries is None:
+			entries = []
+			try:
+				with open(self.filename) as f:
+					for line in f:
+						try:
+							entries.append(json.loads(line))
+						except ValueError:
+							continue
+			except FileNotFoundError:
+				pass
+			self._lines = len(entries)
+			self._entries = entries[-self.max_entries:]
+		return self._entries
+
+	def append(self, entry: Dict[str, Any]):
+		entries = self.entries()
+		entries.append(entry)
+		del entries[:-self.max_entries]
+		if self._lines + 1 >= 2 * self.max_entries:
+			tmp_name = f"{self.filename}.tmp"
+			with open(tmp_name, 'w') as f:
+				for e in entries:
+					f.write(json.dumps(e, separators=(',', ':')) + '\n')
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmp_name, self.filename)
+			self._lines = len(entries)
+		else:
+			with open(self.filename, 'a') as f:
+				f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+			self._lines += 1
+
+	def drift(self, runs: int) -> Optional[Dict[str, float]]:
+		"""
+		Range of every stepper offset and of the endstop Z over the last
+		runs results, None if there are fewer results.
+		"""
+		entries = self.entries()[-runs:]
+		if runs < 1 or len(entries) < runs:
+			return None
+		values: Dict[str, list] = {}
+		for entry in entries:
+			for name, offset in entry['offsets'].items():
+				values.setdefault(name, []).append(offset)
+			if entry.get('endstop_z') is not None:
+				values.setdefault('endstop_z', []).append(entry['endstop_z'])
+		return {name: max(v) - min(v) for name, v in values.items()}
+
+	def is_stable(self, runs: int, tolerance: float) -> Optional[bool]:
+		"""None while there are not enough results to tell"""
+		drift = self.drift(runs)
+		if drift is None:
+			return None
+		return all(value <= tolerance for value in drift.values())
+
+class ResumePrepJob:
+	"""
+	Prepare the resume artifact (virtual prologue or modified file copy) in
+	a background thread while the printer heats and homes. The key
+	identifies the saved state and file the artifact was built for.
+	"""
+	def __init__(self, key: Tuple, prepare_cb: Callable[[], Any]):
+		self.key = key
+		self.prepare_cb = prepare_cb
+		self.result = None
+		self.error: Optional[str] = None
+		self.duration = 0.
+		self.finished = threading.Event()
+		self.thread = threading.Thread(target=self._run, name="plr-resume-prep")
+		self.thread.daemon = True
+
+	def start(self):
+		self.thread.start()
+
+	def is_done(self) -> bool:
+		return self.finished.is_set()
+
+	def _run(self):
+		start = time.monotonic()
+		try:
+			self.result = self.prepare_cb()
+		except Exception as e:
+			logging.exception("PowerLossRecovery: Error preparing resume")
+			self.error = str(e)
+		finally:
+			self.duration = time.monotonic() - start
+			self.finished.set()
+
+def write_variables_file(filename: str, variables: Dict[str, Any]) -> int:
+	"""
+	Write variables in the save_variables file format, replacing the file
+	atomically. Returns the number of bytes written.
+	"""
+	varfile = configparser.ConfigParser()
+	varfile.add_section('Variables')
+	for name, val in sorted(variables.items()):
+		varfile.set('Variables', name, repr(val))
+	tmp_name = f"{filename}.tmp"
+	with open(tmp_name, "w") as f:
+		varfile.write(f)
+		f.flush()
+		os.fsync(f.fileno())
+		nbytes = f.tell()
+	os.replace(tmp_name, filename)
+	return nbytes
+
 class PowerLossRecovery:
 	
 	def _parse_gcode_config_option(self, config, option_name, default=''):
@@ -68,9 +978,53 @@ class PowerLossRecovery:
 			
 			# New configuration options for history
 			self.history_size = config.getint('history_size', 5, minval=2, maxval=20)
-			self.save_delay = config.getint('save_delay', 2, minval=0, 
+			self.save_delay = config.getint('save_delay', 2, minval=0,
 										  maxval=self.history_size - 1)
-			
+
+			# Progress based save policy (bounds the re-execution window)
+			self.save_min_bytes = config.getint('save_min_bytes', 0, minval=0)
+			self.save_max_bytes = config.getint('save_max_bytes', 0, minval=0)
+			self.save_max_print_time = config.getfloat('save_max_print_time', 0., minval=0.)
+			self.progress_check_interval = config.getfloat('progress_check_interval', 1.,
+														  minval=0.1, maxval=30.)
+			# Track the file position actually executed by the MCU
+			self.track_executed_position = config.getboolean('track_executed_position', True)
+			self.position_marker_interval = config.getfloat('position_marker_interval', 0.25,
+														   minval=0.05, maxval=5.)
+			# Flash wear budget for state saves
+			self.write_budget = WriteBudget(
+				config.getint('write_budget_saves_per_hour', 0, minval=0),
+				config.getint('write_budget_bytes_per_hour', 0, minval=0),
+				config.getfloat('write_budget_reserve', 0.25, minval=0., maxval=0.9))
+			
+			# Resume by continuing the original file (virtual) or from a modified copy
+			self.resume_mode = config.getchoice('resume_mode',
+												{'virtual': 'virtual', 'copy': 'copy'},
+												'copy')
+			
+			# Layer index sidecar files built when a print is loaded
+			self.build_layer_index = config.getboolean('build_layer_index', True)
+			self.resume_at_layer_start = config.getboolean('resume_at_layer_start', False)
+			self.restore_modal_state = config.getboolean('restore_modal_state', True)
+			# Leave out objects that were excluded before the power loss
+			self.skip_excluded_objects = config.getboolean('skip_excluded_objects', True)
+			# Only search this many bytes for the placeholders if there is no index (0 = no limit)
+			self.placeholder_scan_bytes = config.getint('placeholder_scan_bytes',
+														16 * 1024 * 1024, minval=0)
+			# Keep or drop slicer thumbnails/config blocks in the header of the resume copy
+			self.resume_header_metadata = config.getchoice('resume_header_metadata',
+														   {'keep': 'keep', 'drop': 'drop'},
+														   'keep')
+			
+			# Write the variables file from a background thread
+			self.background_save = config.getboolean('background_save', True)
+			if self.save_max_bytes and self.save_min_bytes > self.save_max_bytes:
+				raise config.error("save_min_bytes must not exceed save_max_bytes")
+			self.progress_policy_enabled = bool(self.save_max_bytes or self.save_max_print_time)
+			if self.debug_mode:
+				logging.info(f"PowerLossRecovery: Save policy - min bytes: {self.save_min_bytes}, "
+						   f"max bytes: {self.save_max_bytes}, max print time: {self.save_max_print_time}s")
+
 			# Add probe iteration setting
 			self.probe_iteration_count = config.getint('probe_iteration_count', 0, minval=0, maxval=10)
 			if self.debug_mode:
@@ -111,6 +1065,12 @@ class PowerLossRecovery:
 						
 			except Exception as e:
 				raise config.error(f"Error parsing G-code configurations: {str(e)}")
+			
+			# line: wait for the moves after every before/after G-code line,
+			# block: run them as one script and wait once, M400 is a barrier
+			self.operation_gcode_wait = config.getchoice('operation_gcode_wait',
+														{'line': 'line', 'block': 'block'},
+														'line')
 
 				
 			# Important: Check if time-based saving is enabled
@@ -138,12 +1098,26 @@ class PowerLossRecovery:
 		self._last_extruder_change_time = 0
 		self._consecutive_failures = 0
 		self._last_save_attempt = 0
+		# File position and print time of the last saved state
+		self._last_saved_progress: Optional[Tuple[int, float]] = None
 		# Add with other state variables initialization
 		self.power_loss_recovery_enabled = False  # Default to enabled
 		
 		# Initialize history queue
 		self.state_history: Deque[Dict[str, Any]] = deque(maxlen=self.history_size)
 		
+		# print_time -> file position markers from the toolhead lookahead
+		self.mcu = None
+		self.virtual_sdcard = None
+		self._position_markers: Deque[Tuple[float, int, list]] = deque(maxlen=512)
+		self._last_marker_position = None
+		self.state_writer: Optional[StateWriter] = None
+		self.save_stats = SaveStats()
+		self.budget_skipped_saves = 0
+		self._index_builds: Dict[str, threading.Thread] = {}
+		self._resume_prep: Optional[ResumePrepJob] = None
+		self._current_interval = self.save_interval
+		
 		### Z-PLUS HOMING ####
 		
 		self.name = config.get_name()
@@ -153,6 +1127,8 @@ class PowerLossRecovery:
 		self.slow_homing_speed = config.getfloat('slow_homing_speed', 2.0, above=0.)
 		self.retract_dist = config.getfloat('retract_dist', 2.0, above=0.)
 		self.max_adjustment = config.getfloat('max_adjustment', 5.0, above=0.)
+		# RESUME: probe the first endstop only and apply the saved stepper offsets
+		self.fast_resume_homing = config.getboolean('fast_resume_homing', True)
 		self.fast_travel_upto_z_height = config.getfloat('fast_travel_upto_z_height', 0., above=0.)
 		self.fast_travel_speed = config.getfloat('fast_travel_speed', 50.0, above=0.)
 		self.stepper_z_adjust_offset = config.getfloat('stepper_z_adjust_offset', 0.0)
@@ -183,8 +1159,40 @@ class PowerLossRecovery:
 		self.samples_tolerance = config.getfloat('samples_tolerance', 0.100, minval=0.)
 		self.samples_retries = config.getint('samples_retry_count', 5, minval=0)
 		self.samples_tolerance_retries = config.getint('samples_tolerance_retries', 3, minval=0)
+		# fixed: always take sample_size samples, sequential: stop as soon as
+		# the samples agree within samples_tolerance at samples_confidence
+		self.sampling_mode = config.getchoice('sampling_mode',
+											  {'fixed': 'fixed', 'sequential': 'sequential'},
+											  'fixed')
+		self.samples_min = config.getint('samples_min', 2, minval=2)
+		self.samples_confidence = config.getchoice('samples_confidence',
+												   {'0.90': 0.90, '0.95': 0.95, '0.99': 0.99},
+												   '0.95')
+		# Per stepper sample statistics of the last PLR_Z_HOME
+		self.probe_noise: Dict[str, Dict[str, Any]] = {}
 		self.probe_samples_range = config.getfloat('probe_samples_range', 0.5, above=0.)
+		# sequential: probe one stepper at a time, simultaneous: move all Z
+		# steppers together and stop each one on its own endstop
+		self.stepper_probing = config.getchoice('stepper_probing',
+												{'sequential': 'sequential', 'simultaneous': 'simultaneous'},
+												'sequential')
 		self.halt_after_initial_probe = config.getboolean('halt_after_initial_probe', False)
+		self.z_home_timer = PhaseTimer(self.reactor.monotonic)
+		# Append a JSON line per PLR_Z_HOME run with every probing move (empty = off)
+		self.probe_trace_file = config.get('probe_trace_file', '')
+		if self.probe_trace_file:
+			self.probe_trace_file = os.path.expanduser(self.probe_trace_file)
+		self.probe_trace: Optional[ProbeTrace] = None
+		# Keep the last calibration_history_size CALIBRATE results. Saved
+		# offsets are only reused on resume while the last
+		# calibration_stable_runs results agree within calibration_stable_range
+		self.calibration_history_file = config.get('calibration_history_file', '')
+		self.calibration_history_size = config.getint('calibration_history_size', 50, minval=0)
+		self.calibration_stable_runs = config.getint('calibration_stable_runs', 3, minval=2)
+		self.calibration_stable_range = config.getfloat('calibration_stable_range', 0.05, above=0.)
+		self.calibration_history: Optional[CalibrationHistory] = None
+		# Evaluated on ready and after each calibration, read by get_status
+		self.calibration_stable: Optional[bool] = None
 		
 		# Store pin config for each stepper
 		self.pins = {}
@@ -216,10 +1224,14 @@ class PowerLossRecovery:
 		# Variables for storing results
 		self.z_positions = {}
 		self.z_offsets = {}
+		# Saved calibration, read once per operation: {'offsets', 'endstop_position'}
+		self.z_calibration: Optional[Dict[str, Any]] = None
+		self._calibration_endstop_position = None
 		
 		# Register event handlers
 		self.printer.register_event_handler("klippy:connect", self._handle_connect)
 		self.printer.register_event_handler("klippy:ready", self._handle_ready)
+		self.printer.register_event_handler("klippy:disconnect", self._handle_disconnect)
 		self.printer.register_event_handler("extruder:activate_extruder",
 										  self._handle_activate_extruder)
 		self.printer.register_event_handler('klippy:mcu_identify',
@@ -229,6 +1241,8 @@ class PowerLossRecovery:
 										  self._handle_print_complete)
 		self.printer.register_event_handler("print_stats:error", 
 										  self._handle_print_complete)
+		self.printer.register_event_handler("virtual_sdcard:load_file",
+										  self._handle_load_file)
 										  
 		# Setup GCode commands
 		self.gcode = self.printer.lookup_object('gcode')
@@ -262,6 +1276,9 @@ class PowerLossRecovery:
 		self.gcode.register_command('PLR_RESUME_PRINT', 
 								self.cmd_PLR_RESUME_PRINT,
 								desc=self.cmd_PLR_RESUME_PRINT_help)
+		self.gcode.register_command('PLR_PREPARE_RESUME',
+								self.cmd_PLR_PREPARE_RESUME,
+								desc=self.cmd_PLR_PREPARE_RESUME_help)
 
 		self.gcode.register_command('PLR_SAVE_MESH',
 									  self.cmd_PLR_SAVE_MESH,
@@ -270,9 +1287,16 @@ class PowerLossRecovery:
 									  self.cmd_PLR_LOAD_MESH,
 									  desc=self.cmd_PLR_LOAD_MESH_help)
 									  
+		self.gcode.register_command('PLR_BUILD_INDEX',
+									  self.cmd_PLR_BUILD_INDEX,
+									  desc=self.cmd_PLR_BUILD_INDEX_help)
+									  
 		self.gcode.register_command('PLR_TEST_APPLY_OFFSETS',
 		  self.cmd_PLR_TEST_APPLY_OFFSETS,
 		  desc=self.cmd_PLR_TEST_APPLY_OFFSETS_help)
+		self.gcode.register_command('PLR_CALIBRATION_HISTORY',
+									  self.cmd_PLR_CALIBRATION_HISTORY,
+									  desc=self.cmd_PLR_CALIBRATION_HISTORY_help)
 									  
 	### Z-PLUS HOMING #####
 	
@@ -300,63 +1324,121 @@ class PowerLossRecovery:
 			self.stepper_names.append(stepper.get_name())
 			endstop.add_stepper(stepper)
 			
-	def _load_saved_z_offsets(self):
-		"""Load saved Z offsets from variables file"""
-		if not self.save_variables:
-			return {}
-			
-		loaded_offsets = {}
-		try:
-			# Get variables directly from save_variables status
-			eventtime = self.printer.get_reactor().monotonic()
-			variables = self.save_variables.get_status(eventtime)['variables']
-			
-			for name in self.stepper_names:
-				var_name = f"z_offset_{name}"
-				try:
-					# Look directly in variables dictionary
-					if var_name in variables:
-						offset = float(variables[var_name])
-						loaded_offsets[name] = offset
-						if self.debug_mode:
-							self._debug_log(f"Loaded offset for {name}: {offset:.3f}mm")
-					else:
+	def _get_z_calibration(self, reload=False) -> Dict[str, Any]:
+		"""
+		Saved stepper offsets and reference endstop position. The variables
+		are only read on the first call or with reload=True.
+		"""
+		if self.z_calibration is not None and not reload:
+			return self.z_calibration
+		
+		offsets = {}
+		endstop_position = None
+		if self.save_variables:
+			try:
+				eventtime = self.reactor.monotonic()
+				variables = self.save_variables.get_status(eventtime)['variables']
+				for name in self.stepper_names:
+					var_name = f"z_offset_{name}"
+					if var_name not in variables:
 						if self.debug_mode:
 							self._debug_log(f"No saved offset found for {name}")
-				except Exception as e:
-					if self.debug_mode:
-						self._debug_log(f"Error loading offset for {name}: {str(e)}")
-					continue
-			
-			if self.debug_mode:
-				if loaded_offsets:
-					self._debug_log("Successfully loaded offsets:")
-					for name, offset in loaded_offsets.items():
-						self._debug_log(f"{name}: {offset:.3f}mm")
-				else:
-					self._debug_log("No valid offsets found in variables file")
-					
-			return loaded_offsets
+						continue
+					try:
+						offsets[name] = float(variables[var_name])
+					except (TypeError, ValueError) as e:
+						if self.debug_mode:
+							self._debug_log(f"Error loading offset for {name}: {str(e)}")
+				endstop_position = variables.get('z_endstop_position_stepper_z')
+			except Exception as e:
+				self._debug_log(f"Error loading saved offsets: {str(e)}")
 		
-		except Exception as e:
-			self._debug_log(f"Error loading saved offsets: {str(e)}")
-			return {}
-			
-	def _save_z_offset(self, name, z_offset):
-		"""Save Z offset to Klipper variables"""
+		if self.debug_mode:
+			if offsets:
+				self._debug_log("Successfully loaded offsets:")
+				for name, offset in offsets.items():
+					self._debug_log(f"{name}: {offset:.3f}mm")
+			else:
+				self._debug_log("No valid offsets found in variables file")
+		
+		self.z_calibration = {'offsets': offsets, 'endstop_position': endstop_position}
+		return self.z_calibration
+	
+	def _save_z_calibration(self, offsets, endstop_position=None):
+		"""
+		Save all stepper offsets and the reference endstop position with a
+		single atomic write of the variables file.
+		"""
 		if not self.save_variables:
 			return
 		try:
-			var_name = f"z_offset_{name}"
-			save_cmd = self.gcode.create_gcode_command(
-				"SAVE_VARIABLE", "SAVE_VARIABLE",
-				{"VARIABLE": var_name, "VALUE": z_offset})
-			self.save_variables.cmd_SAVE_VARIABLE(save_cmd)
+			variables = self._snapshot_variables()
+			for name, offset in offsets.items():
+				variables[f"z_offset_{name}"] = offset
+			if endstop_position is not None:
+				variables['z_endstop_position_stepper_z'] = list(endstop_position)
+			self.save_variables.allVariables = variables
+			
+			if self.state_writer is not None:
+				# The writer thread owns the variables file
+				self.state_writer.submit()
+			else:
+				save_start = self.reactor.monotonic()
+				nbytes = write_variables_file(self.save_variables.filename, variables)
+				self.save_stats.record_save(self.reactor.monotonic() - save_start, nbytes)
 		except Exception as e:
 			raise self.printer.command_error(
-				f"Error saving Z offset for {name}: {str(e)}")
-	
+				f"Error saving Z calibration: {str(e)}")
 		
+		calibration = self._get_z_calibration()
+		calibration['offsets'].update(offsets)
+		if endstop_position is not None:
+			calibration['endstop_position'] = list(endstop_position)
+		if self.debug_mode:
+			self._debug_log(f"Saved Z calibration: {', '.join(f'{n}: {o:.3f}' for n, o in offsets.items())}")
+	
+	def _get_calibration_history(self) -> Optional[CalibrationHistory]:
+		if self.calibration_history is None and self.calibration_history_size:
+			filename = self.calibration_history_file
+			if filename:
+				filename = os.path.expanduser(filename)
+			else:
+				filename = os.path.join(os.path.dirname(self.save_variables.filename),
+										'plr_calibration_history.jsonl')
+			self.calibration_history = CalibrationHistory(filename, self.calibration_history_size)
+		return self.calibration_history
+	
+	def _record_calibration(self, endstop_position):
+		"""Add the result of a completed CALIBRATE to the calibration history"""
+		history = self._get_calibration_history()
+		if history is None:
+			return
+		entry = {
+			'time': round(time.time(), 1),
+			'offsets': {name: round(offset, 5) for name, offset in self.z_offsets.items()},
+			'endstop_z': round(endstop_position[2], 5) if endstop_position else None,
+			'spread': {name: noise.get('stdev', 0.) for name, noise in self.probe_noise.items()},
+			'samples': {name: noise.get('samples', 0) for name, noise in self.probe_noise.items()},
+		}
+		try:
+			history.append(entry)
+		except Exception as e:
+			logging.info(f"PowerLossRecovery: Error writing calibration history: {str(e)}")
+		self._update_calibration_stable()
+	
+	def _update_calibration_stable(self):
+		"""Re-evaluate calibration_stable from the calibration history"""
+		history = self._get_calibration_history()
+		if history is None:
+			self.calibration_stable = None
+			return
+		try:
+			self.calibration_stable = history.is_stable(self.calibration_stable_runs,
+														self.calibration_stable_range)
+		except Exception as e:
+			logging.info(f"PowerLossRecovery: Error reading calibration history: {str(e)}")
+			self.calibration_stable = None
+	
 	def _get_stepper_position_in_steps(self, stepper):
 		"""Get the raw stepper position in microsteps"""
 		try:
@@ -372,20 +1454,80 @@ class PowerLossRecovery:
 				self._debug_log(f"Error getting stepper position: {str(e)}")
 			return None, None
 	
-	def _get_averaged_position(self, stepper, samples=5, delay=0.100):
-		"""Get an averaged stepper position reading to reduce measurement noise."""
-		positions = []
-		for _ in range(samples):
-			positions.append(stepper.get_mcu_position())
-			self.toolhead.dwell(delay)
-		return sum(positions) / len(positions)
-	
-	def _verify_movement_completion(self, stepper, tolerance=1):
-		"""Verify that stepper movement has completely settled."""
-		initial_pos = stepper.get_mcu_position()
-		self.toolhead.dwell(0.250)
-		final_pos = stepper.get_mcu_position()
-		return abs(final_pos - initial_pos) < tolerance
+	def _wait_for_settle(self, stepper):
+		"""
+		Wait until the queued moves completed. get_mcu_position() is derived
+		from the commanded position on the host, so polling it can't tell
+		more than the move queue.
+		"""
+		self.z_home_timer.push('settle')
+		try:
+			start_time = self.reactor.monotonic()
+			self.toolhead.wait_moves()
+			if self.probe_trace is not None:
+				self.probe_trace.add('settle', name=stepper.get_name(),
+									 duration=self.reactor.monotonic() - start_time)
+		finally:
+			self.z_home_timer.pop()
+	
+	def _endstops_probing_move(self, endstops, pos, speed) -> Tuple[list, Dict[str, Tuple[int, int]]]:
+		"""
+		Probing move towards pos with a list of (endstop, name) pairs. Each
+		endstop only stops its own steppers and the move ends once all of
+		them triggered, like homing a rail with several endstops.
+		Returns (trigger_toolhead_position,
+		{stepper_name: (start_mcu_pos, trigger_mcu_pos)}).
+		"""
+		from . import homing
+		trace = None
+		if self.probe_trace is not None:
+			trace = {'phase': self.z_home_timer.current(),
+					 'names': [name for _, name in endstops], 'speed': speed,
+					 'start_z': self.toolhead.get_position()[2], 'target_z': pos[2]}
+		self.z_home_timer.push('probing_move')
+		start_time = self.reactor.monotonic()
+		try:
+			hmove = homing.HomingMove(self.printer, endstops)
+			try:
+				epos = hmove.homing_move(pos, speed, probe_pos=True)
+			except self.printer.command_error:
+				if self.printer.is_shutdown():
+					raise self.printer.command_error("Probing failed due to printer shutdown")
+				raise
+			if hmove.check_no_movement() is not None:
+				raise self.printer.command_error("Probe triggered prior to movement")
+		except self.printer.command_error as e:
+			if trace is not None:
+				self.probe_trace.add('probe', duration=self.reactor.monotonic() - start_time,
+									 error=str(e), **trace)
+			raise
+		finally:
+			self.z_home_timer.pop()
+		
+		positions = {sp.stepper.get_name(): (sp.start_pos, sp.trig_pos)
+					 for sp in hmove.stepper_positions}
+		if trace is not None:
+			# Commanded target vs measured trigger position and travel per stepper
+			travel = {sp.stepper.get_name(): round(
+						  (sp.trig_pos - sp.start_pos) * sp.stepper.get_step_dist(), 5)
+					  for sp in hmove.stepper_positions}
+			self.probe_trace.add('probe', duration=self.reactor.monotonic() - start_time,
+								 trigger_z=epos[2], travel=travel, **trace)
+		return epos, positions
+	
+	def _stepper_probing_move(self, stepper, endstop, pos, speed) -> Tuple[list, int, int]:
+		"""
+		Probing move towards pos that stops when endstop triggers, like
+		homing.probing_move, but also returns the exact MCU position of
+		stepper at the start of the move and at the endstop trigger time.
+		Returns (trigger_toolhead_position, start_mcu_pos, trigger_mcu_pos).
+		"""
+		name = stepper.get_name()
+		epos, positions = self._endstops_probing_move([(endstop, name)], pos, speed)
+		if name not in positions:
+			raise self.printer.command_error(f"{name} is not driven by its endstop")
+		start_pos, trig_pos = positions[name]
+		return epos, start_pos, trig_pos
 	
 	def _log_movement_stats(self, name, positions, trigger_times):
 		"""Log statistical data about movement precision."""
@@ -423,26 +1565,16 @@ class PowerLossRecovery:
 		"""
 		# Enhanced initialization and position tracking
 		toolhead = self.printer.lookup_object('toolhead')
-		mcu = self.printer.lookup_object('mcu')
-		
-		# Flush motion queue and ensure stability
-		print_time = toolhead.get_last_move_time()
-		mcu.flush_moves(print_time, print_time)
-		toolhead.wait_moves()
-		
-		# Increased dwell time for stability
-		toolhead.dwell(1.000)
 		
 		# Debug logging
 		if self.debug_mode:
 			self._debug_log(f"\nStarting probe sequence for {name}")
 			self._debug_log(f"Reference Z height: {ref_z}")
 		
-		# Verify movement stability before starting
-		if not self._verify_movement_completion(stepper):
-			raise self.printer.command_error(f"{name} movement not stable")
+		# Wait for the stepper to stop before reading its position
+		self._wait_for_settle(stepper)
 			
-		# Get initial position with averaging
+		# Get initial position
 		initial_pos, steps_per_mm = self._get_stepper_position_in_steps(stepper)
 		if initial_pos is None:
 			raise self.printer.command_error(f"Unable to get initial position for {name}")
@@ -460,22 +1592,16 @@ class PowerLossRecovery:
 			probe_pos = list(toolhead.get_position())
 			probe_pos[2] = self.position_endstop
 			
-			# Enhanced position recording with averaging
-			pre_probe_pos = self._get_averaged_position(stepper)
 			probe_start_time = self.reactor.monotonic()
 			
-			if self.debug_mode:
-				self._debug_log(f"{name} averaged position before probe: {pre_probe_pos} steps")
-			
 			# Perform initial probe
-			measured_pos = self.printer.lookup_object('homing').probing_move(
-				endstop, probe_pos, self.fast_move_speed)
-				
-			# Record triggered position with averaging
-			toolhead.dwell(0.100)  # Allow settling
-			trigger_pos = self._get_averaged_position(stepper)
+			measured_pos, pre_probe_pos, trigger_pos = self._stepper_probing_move(
+				stepper, endstop, probe_pos, self.fast_move_speed)
 			trigger_time = self.reactor.monotonic()
 			
+			if self.debug_mode:
+				self._debug_log(f"{name} position before probe: {pre_probe_pos} steps")
+			
 			# Track positions and timing for statistics
 			position_samples.append(trigger_pos)
 			trigger_times.append(trigger_time - probe_start_time)
@@ -483,11 +1609,6 @@ class PowerLossRecovery:
 			# Calculate initial travel distance with enhanced precision
 			initial_travel = self._calculate_stepper_movement(stepper, pre_probe_pos, trigger_pos, steps_per_mm)
 			
-			# Flush motion queue after probe
-			print_time = toolhead.get_last_move_time()
-			mcu.flush_moves(print_time, print_time)
-			toolhead.wait_moves()
-			
 			if self.debug_mode:
 				self._debug_log(f"{name} initial trigger position: {trigger_pos} steps")
 				self._debug_log(f"Initial travel distance: {initial_travel:.3f}mm")
@@ -503,16 +1624,19 @@ class PowerLossRecovery:
 		retract_pos = list(toolhead.get_position())
 		retract_pos[2] -= self.sample_retract_dist
 		toolhead.manual_move(retract_pos, self.fast_move_speed)
-		toolhead.wait_moves()
 		
-		# Get position after retraction - this becomes our base position
-		base_pos = self._get_averaged_position(stepper)
+		# Get position after retraction - this becomes our base position. The
+		# steps only need to be generated, not executed
+		toolhead.flush_step_generation()
+		base_pos = stepper.get_mcu_position()
 		if self.debug_mode:
 			self._debug_log(f"{name} base position for sampling: {base_pos} steps")
 		
 		# Collect samples of total travel distance
 		samples = []
 		retry_count = 0
+		rejected = 0
+		probe_moves = 1
 		
 		while len(samples) < self.sample_count:
 			if retry_count >= self.samples_retries:
@@ -524,30 +1648,18 @@ class PowerLossRecovery:
 				probe_start_pos = list(toolhead.get_position())
 				probe_start_pos[2] = measured_pos[2] - self.sample_retract_dist
 				toolhead.manual_move(probe_start_pos, self.slow_homing_speed)
-				toolhead.wait_moves()
-				
-				# Enhanced position recording for samples
-				if not self._verify_movement_completion(stepper):
-					if self.debug_mode:
-						self._debug_log(f"Movement not stable before sample {len(samples) + 1}")
-					continue
-					
-				pre_sample_pos = self._get_averaged_position(stepper)
 				sample_start_time = self.reactor.monotonic()
 				
+				# Perform sample probe, the move starts once the queue is flushed
+				probe_moves += 1
+				sample_pos, pre_sample_pos, trigger_sample_pos = self._stepper_probing_move(
+					stepper, endstop, probe_pos, self.slow_homing_speed)
+				sample_trigger_time = self.reactor.monotonic()
+				
 				if self.debug_mode:
 					self._debug_log(f"\nSample {len(samples) + 1}:")
 					self._debug_log(f"Starting position: {pre_sample_pos} steps")
 				
-				# Perform sample probe
-				sample_pos = self.printer.lookup_object('homing').probing_move(
-					endstop, probe_pos, self.slow_homing_speed)
-				
-				# Enhanced trigger position recording
-				toolhead.dwell(0.100)  # Allow settling
-				trigger_sample_pos = self._get_averaged_position(stepper)
-				sample_trigger_time = self.reactor.monotonic()
-				
 				# Track positions and timing
 				position_samples.append(trigger_sample_pos)
 				trigger_times.append(sample_trigger_time - sample_start_time)
@@ -558,12 +1670,36 @@ class PowerLossRecovery:
 				
 				# Calculate total travel distance (initial + sample)
 				total_travel = initial_travel + sample_travel
+				self._trace('sample', name=name, value=total_travel)
 				
 				if self.debug_mode:
 					self._debug_log(f"Sample trigger position: {trigger_sample_pos} steps")
 					self._debug_log(f"Sample travel from base: {sample_travel:.3f}mm")
 					self._debug_log(f"Total travel distance: {total_travel:.3f}mm")
 				
+				if self.sampling_mode == 'sequential':
+					# Robust outlier rejection, a new sample can also expose an older outlier
+					samples.append(total_travel)
+					outliers = find_outliers(samples, self.samples_tolerance)
+					if outliers:
+						if self.debug_mode:
+							self._debug_log(f"Rejecting outlier samples: "
+											f"{', '.join(f'{samples[i]:.4f}' for i in outliers)}mm")
+						self._trace('retry', name=name, reason='outlier', count=len(outliers))
+						samples = [v for i, v in enumerate(samples) if i not in outliers]
+						rejected += len(outliers)
+						retry_count += len(outliers)
+					half_width = confidence_half_width(samples, self.samples_confidence)
+					if len(samples) >= self.samples_min and half_width <= self.samples_tolerance:
+						if self.debug_mode:
+							self._debug_log(f"Samples agree within {half_width:.4f}mm at "
+											f"{self.samples_confidence:.0%} confidence after "
+											f"{len(samples)} samples")
+						break
+					if len(samples) < self.sample_count:
+						toolhead.manual_move(retract_pos, self.slow_homing_speed)
+					continue
+				
 				# Verify sample is within allowed range
 				if samples:
 					existing_min = min(samples)
@@ -573,24 +1709,20 @@ class PowerLossRecovery:
 							self._debug_log(
 								f"Sample outside allowed range: {total_travel:.3f}mm "
 								f"(min: {existing_min:.3f}mm, max: {existing_max:.3f}mm)")
+						self._trace('retry', name=name, reason='range')
 						retry_count += 1
 						continue
 				
-				# Flush motion queue after sample
-				print_time = toolhead.get_last_move_time()
-				mcu.flush_moves(print_time, print_time)
-				toolhead.wait_moves()
-				
 				samples.append(total_travel)
 				
 				# Retract after sample if not the last one
 				if len(samples) < self.sample_count:
 					toolhead.manual_move(retract_pos, self.slow_homing_speed)
-					toolhead.wait_moves()
 				
 			except self.printer.command_error as e:
 				retry_count += 1
 				if "triggered prior to movement" in str(e):
+					self._trace('retry', name=name, reason='triggered')
 					if self.debug_mode:
 						self._debug_log(f"Endstop triggered before movement, retrying")
 					continue
@@ -598,6 +1730,11 @@ class PowerLossRecovery:
 		
 		# Log movement statistics
 		self._log_movement_stats(name, position_samples, trigger_times)
+		noise = sample_statistics(samples)
+		noise.update({'samples': len(samples), 'rejected': rejected, 'probe_moves': probe_moves})
+		self.probe_noise[name] = noise
+		if self.debug_mode:
+			self._debug_log(f"{name} sample statistics: {noise}")
 		
 		# Calculate final trigger height with enhanced precision
 		samples.sort()
@@ -617,25 +1754,20 @@ class PowerLossRecovery:
 		Args:
 			toolhead: Klipper toolhead object
 			stepper_name: Name of stepper to adjust, or None for all steppers
-			mode: 'CALIBRATE' or 'RESUME' to determine offset source
+			mode: 'CALIBRATE' or 'RESUME' to determine offset source.
+				RESUME applies the saved calibration, the offsets probed
+				just before still contain the tilt the print left behind.
+				Only steppers without a saved offset use the probed one.
 		"""
-		mcu = self.printer.lookup_object('mcu')
-		print_time = toolhead.get_last_move_time()
-		
-		# Load saved positions for kinematic reset
+		# Load saved offsets and positions for kinematic reset
+		saved_offsets = {}
 		saved_positions = None
 		if mode == 'RESUME':
-			try:
-				eventtime = self.printer.get_reactor().monotonic()
-				variables = self.save_variables.get_status(eventtime)['variables']
-				ref_pos_key = 'z_endstop_position_stepper_z'
-				if ref_pos_key in variables:
-					saved_positions = variables[ref_pos_key]
-					if self.debug_mode:
-						self._debug_log(f"Found reference position: {saved_positions}")
-			except Exception as e:
-				if self.debug_mode:
-					self._debug_log(f"Error loading reference position: {str(e)}")
+			calibration = self._get_z_calibration()
+			saved_offsets = calibration['offsets']
+			saved_positions = calibration['endstop_position']
+			if self.debug_mode and saved_positions:
+				self._debug_log(f"Found reference position: {saved_positions}")
 		
 		# Get stepper list to process
 		steppers_to_process = []
@@ -658,8 +1790,10 @@ class PowerLossRecovery:
 			# Process each stepper
 			for stepper, name in steppers_to_process:
 				# Get base offset based on mode and apply adjustment
-				base_offset = self.z_offsets.get(name, 0) if mode == 'CALIBRATE' else \
-							self._load_saved_z_offsets().get(name, 0)
+				if mode == 'CALIBRATE' or name not in saved_offsets:
+					base_offset = self.z_offsets.get(name, 0)
+				else:
+					base_offset = saved_offsets[name]
 				# Apply adjustment offset during actual movement
 				adjustment = self.stepper_adjust_offsets.get(name, 0)
 				offset = base_offset + adjustment
@@ -674,15 +1808,11 @@ class PowerLossRecovery:
 						self._debug_log(f"No offset to apply for {name}")
 					continue
 		
-				# Isolate current stepper
+				# Isolate current stepper once the queued moves generated their steps
+				toolhead.flush_step_generation()
 				for s in self.z_steppers:
 					s.set_trapq(None)
 				stepper.set_trapq(toolhead.get_trapq())
-				toolhead.dwell(0.100)
-		
-				# Clear motion queue
-				mcu.flush_moves(print_time, print_time)
-				toolhead.wait_moves()
 		
 				# Apply offset
 				current_pos = toolhead.get_position()
@@ -699,33 +1829,252 @@ class PowerLossRecovery:
 		
 				# Move to new position
 				toolhead.manual_move(new_pos, self.slow_homing_speed)
-				toolhead.wait_moves()
 		
 				# Reset kinematic position if processing multiple steppers
 				if not stepper_name and saved_positions:
-					try:
-						# Apply z_height_offset to the Z position
-						adjusted_z = saved_positions[2] + self.z_height_offset
-						reset_cmd = f"SET_KINEMATIC_POSITION Z={adjusted_z}"
-						if self.debug_mode:
-							self._debug_log(f"Resetting kinematic position with Z offset: {reset_cmd}")
-						self.gcode.run_script_from_command(reset_cmd)
-						toolhead.dwell(0.100)
-					except Exception as e:
-						if self.debug_mode:
-							self._debug_log(f"Error resetting kinematic position: {str(e)}")
+					self._reset_kinematic_z(saved_positions)
 		
-				if mode == 'CALIBRATE':
-					self._save_z_offset(name, base_offset)
-				
 		finally:
 			# Restore normal stepper operation
-			print_time = toolhead.get_last_move_time()
-			mcu.flush_moves(print_time, print_time)
-			toolhead.wait_moves()
+			toolhead.flush_step_generation()
 			for stepper in self.z_steppers:
 				stepper.set_trapq(toolhead.get_trapq())
 	
+	def _reset_kinematic_z(self, endstop_position):
+		"""Set the toolhead Z to the saved endstop position plus z_height_offset"""
+		try:
+			adjusted_z = endstop_position[2] + self.z_height_offset
+			reset_cmd = f"SET_KINEMATIC_POSITION Z={adjusted_z}"
+			if self.debug_mode:
+				self._debug_log(f"Resetting kinematic position with Z offset: {reset_cmd}")
+			self.gcode.run_script_from_command(reset_cmd)
+		except Exception as e:
+			if self.debug_mode:
+				self._debug_log(f"Error resetting kinematic position: {str(e)}")
+	
+	def _check_cached_calibration(self, probe_travel):
+		"""
+		Check if the saved stepper offsets can be reused for a RESUME home.
+		probe_travel is the Z distance the initial probe moved up from the
+		position set by before_resume_gcode. Returns (offsets, None) or
+		(None, reason).
+		"""
+		calibration = self._get_z_calibration()
+		offsets = dict(calibration['offsets'])
+		missing = [name for name in self.stepper_names[1:] if name not in offsets]
+		if missing:
+			return None, f"no saved offset for {', '.join(missing)}"
+		for name, offset in offsets.items():
+			if abs(offset) > self.max_adjustment:
+				return None, f"saved offset of {name} ({offset:.3f}mm) exceeds max_adjustment"
+		
+		saved_endstop = calibration['endstop_position']
+		if not saved_endstop:
+			return None, "no saved endstop position"
+		
+		# The probe should have found the endstop where the calibration put
+		# it, seen from the Z height the print was interrupted at
+		state_data = self._get_saved_state()
+		if state_data:
+			expected_travel = saved_endstop[2] - state_data['position']['z']
+			drift = probe_travel - expected_travel
+			if self.debug_mode:
+				self._debug_log(f"Z reference drift since calibration: {drift:.3f}mm")
+			if abs(drift) > self.max_adjustment:
+				return None, f"Z reference drifted {drift:.3f}mm since calibration"
+		
+		if self.calibration_stable is False:
+			return None, "calibration results drifted between recent calibrations"
+		
+		offsets.setdefault(self.stepper_names[0], 0.0)
+		return offsets, None
+	
+	def _measure_trigger_heights(self, toolhead, reference_z):
+		"""Probe all Z steppers from reference_z, returns {stepper_name: trigger_height}"""
+		if self.stepper_probing == 'simultaneous' and len(self.z_steppers) > 1:
+			return self._probe_steppers_together(toolhead, reference_z)
+		return self._probe_steppers_sequentially(toolhead, reference_z)
+	
+	def _probe_steppers_sequentially(self, toolhead, reference_z):
+		"""Probe one Z stepper after the other with the others disabled"""
+		heights = {}
+		for i, (stepper, endstop, name) in enumerate(zip(
+			self.z_steppers, self.endstops, self.stepper_names)):
+			
+			if self.debug_mode:
+				self._debug_log(f"\nProbing {name} (stepper {i+1} of {len(self.z_steppers)})")
+			
+			# Disable all steppers except the current one
+			toolhead.flush_step_generation()
+			for s in self.z_steppers:
+				s.set_trapq(None)
+			stepper.set_trapq(toolhead.get_trapq())
+			
+			try:
+				heights[name] = self._probe_single_stepper(
+					stepper, endstop, name, reference_z)
+			except Exception as e:
+				# Re-enable all steppers before raising error
+				toolhead.flush_step_generation()
+				for s in self.z_steppers:
+					s.set_trapq(toolhead.get_trapq())
+				raise self.printer.command_error(
+					f"Error probing {name}: {str(e)}")
+		
+		# Re-enable all steppers
+		toolhead.flush_step_generation()
+		for s in self.z_steppers:
+			s.set_trapq(toolhead.get_trapq())
+		return heights
+	
+	def _probe_steppers_together(self, toolhead, reference_z):
+		"""
+		Probe all Z steppers in the same upward moves. Every stepper stops on
+		its own endstop, so each move samples all of them. Uses the same
+		sampling rules as _probe_single_stepper.
+		"""
+		names = self.stepper_names
+		endstops = list(zip(self.endstops, names))
+		step_dists = {name: stepper.get_step_dist()
+					  for stepper, name in zip(self.z_steppers, names)}
+		toolhead.flush_step_generation()
+		for s in self.z_steppers:
+			s.set_trapq(toolhead.get_trapq())
+		
+		if self.debug_mode:
+			self._debug_log(f"\nProbing {', '.join(names)} together from Z={reference_z:.3f}")
+		
+		probe_pos = list(toolhead.get_position())
+		probe_pos[2] = self.position_endstop
+		try:
+			measured_pos, positions = self._endstops_probing_move(
+				endstops, probe_pos, self.fast_move_speed)
+		except self.printer.command_error as e:
+			if "triggered prior to movement" in str(e):
+				raise self.printer.command_error(
+					"Z endstop triggered before movement. Check Z position and endstops.")
+			raise
+		initial_travel = {name: (trig_pos - start_pos) * step_dists[name]
+						  for name, (start_pos, trig_pos) in positions.items()}
+		if self.debug_mode:
+			for name in names:
+				self._debug_log(f"{name} initial travel distance: {initial_travel[name]:.3f}mm")
+		
+		# Retract all steppers together, each keeps its distance to its endstop
+		retract_pos = list(toolhead.get_position())
+		retract_pos[2] -= self.sample_retract_dist
+		toolhead.manual_move(retract_pos, self.fast_move_speed)
+		toolhead.flush_step_generation()
+		base_pos = {name: stepper.get_mcu_position()
+					for stepper, name in zip(self.z_steppers, names)}
+		
+		samples = {name: [] for name in names}
+		rejected = dict.fromkeys(names, 0)
+		done = set()
+		retry_count = 0
+		probe_moves = 1
+		
+		while len(done) < len(names):
+			if retry_count >= self.samples_retries:
+				pending = ', '.join(name for name in names if name not in done)
+				raise self.printer.command_error(
+					f"Unable to get consistent samples for {pending} after {retry_count} retries")
+			
+			toolhead.manual_move(retract_pos, self.slow_homing_speed)
+			probe_moves += 1
+			try:
+				_, positions = self._endstops_probing_move(
+					endstops, probe_pos, self.slow_homing_speed)
+			except self.printer.command_error as e:
+				retry_count += 1
+				if "triggered prior to movement" in str(e):
+					self._trace('retry', name=', '.join(names), reason='triggered')
+					if self.debug_mode:
+						self._debug_log(f"Endstop triggered before movement, retrying")
+					continue
+				raise
+			
+			for name in names:
+				if name in done:
+					continue
+				values = samples[name]
+				total_travel = (initial_travel[name]
+								+ (positions[name][1] - base_pos[name]) * step_dists[name])
+				self._trace('sample', name=name, value=total_travel)
+				if self.debug_mode:
+					self._debug_log(f"{name} sample {len(values) + 1}: {total_travel:.3f}mm")
+				
+				if self.sampling_mode == 'sequential':
+					values.append(total_travel)
+					outliers = find_outliers(values, self.samples_tolerance)
+					if outliers:
+						self._trace('retry', name=name, reason='outlier', count=len(outliers))
+						values[:] = [v for i, v in enumerate(values) if i not in outliers]
+						rejected[name] += len(outliers)
+						retry_count += len(outliers)
+					if len(values) >= self.sample_count or (
+							len(values) >= self.samples_min and
+							confidence_half_width(values, self.samples_confidence) <= self.samples_tolerance):
+						done.add(name)
+					continue
+				
+				if values and max(abs(total_travel - min(values)),
+								  abs(total_travel - max(values))) > self.probe_samples_range:
+					if self.debug_mode:
+						self._debug_log(f"{name} sample outside allowed range: {total_travel:.3f}mm")
+					self._trace('retry', name=name, reason='range')
+					retry_count += 1
+					continue
+				values.append(total_travel)
+				if len(values) >= self.sample_count:
+					done.add(name)
+		
+		heights = {}
+		for name in names:
+			values = sorted(samples[name])
+			noise = sample_statistics(values)
+			noise.update({'samples': len(values), 'rejected': rejected[name],
+						  'probe_moves': probe_moves})
+			self.probe_noise[name] = noise
+			heights[name] = values[len(values)//2]  # Use median for robustness
+			if self.debug_mode:
+				self._debug_log(f"{name} sample statistics: {noise}")
+				self._debug_log(f"{name} selected trigger height: {heights[name]:.3f}mm")
+		return heights
+	
+	def _probe_z_steppers(self, toolhead, mode, reference_z):
+		"""Probe every Z stepper and store the offsets to the first one"""
+		self.z_home_timer.start('stepper_probing')
+		self._debug_log("\nStarting individual stepper probing...")
+		
+		heights = self._measure_trigger_heights(toolhead, reference_z)
+		first_trigger = heights[self.stepper_names[0]]
+		for name in self.stepper_names:
+			# Offset relative to first stepper without adjustment, the
+			# reference stepper always has 0 offset
+			self.z_offsets[name] = first_trigger - heights[name]
+			if self.debug_mode:
+				self._debug_log(f"{name} final offset: {self.z_offsets[name]:.3f}mm")
+		
+		# Store initial offsets after first probing round
+		initial_offsets = self.z_offsets.copy()
+		
+		if self.probe_iteration_count > 1 and mode == 'CALIBRATE':
+			if self.debug_mode:
+				self._debug_log(
+					f"\nStarting additional {self.probe_iteration_count} probe iterations")
+			
+			self.z_home_timer.start('iterations')
+			try:
+				# Perform iterative probing and get final offsets
+				final_offsets = self._probe_with_iterations(toolhead, initial_offsets)
+				
+				# Update z_offsets with final calculated values
+				self.z_offsets.update(final_offsets)
+			except Exception as e:
+				raise self.printer.command_error(
+					f"Error during probe iterations: {str(e)}")
+
 	def _probe_with_iterations(self, toolhead, initial_offsets):
 		"""
 		Perform multiple probe iterations after initial probing.
@@ -763,64 +2112,32 @@ class PowerLossRecovery:
 				retract_pos[2] = max(current_pos[2] - self.retract_dist, 0)  # Prevent negative Z
 				
 				# Enable all steppers for full Z movement
+				toolhead.flush_step_generation()
 				for s in self.z_steppers:
 					s.set_trapq(toolhead.get_trapq())
-				toolhead.dwell(0.100)  # Wait for steppers to be enabled
 				
-				# Move down
+				# Move down, the next probing move flushes it
 				if self.debug_mode:
 					self._debug_log(f"\nRetracting Z axis to {retract_pos[2]:.3f} before iteration {iteration + 1}")
 				toolhead.manual_move(retract_pos, self.fast_move_speed)
-				toolhead.wait_moves()
 				
 				reference_z = retract_pos[2]  # Use retracted position as new reference
 				
-				# Probe each stepper in this iteration
-				for i, (stepper, endstop, name) in enumerate(zip(
-					self.z_steppers, self.endstops, self.stepper_names)):
-					
+				# Probe all steppers in this iteration
+				try:
+					heights = self._measure_trigger_heights(toolhead, reference_z)
+				except Exception as e:
+					raise self.printer.command_error(
+						f"Error in iteration {iteration + 1}: {str(e)}")
+				
+				first_trigger = heights[self.stepper_names[0]]
+				for name in self.stepper_names:
+					# Offset relative to the first stepper, always 0 for the reference
+					offset = first_trigger - heights[name]
+					iteration_results[name].append(offset)
 					if self.debug_mode:
-						self._debug_log(f"\nIterative probe {name} (iteration {iteration + 1})")
-					
-					# Disable all steppers except current one
-					for s in self.z_steppers:
-						s.set_trapq(None)
-					stepper.set_trapq(toolhead.get_trapq())
-					toolhead.dwell(0.500)
-					
-					try:
-						# Probe this stepper
-						trigger_height = self._probe_single_stepper(
-							stepper, endstop, name, reference_z)
-						
-						# Store result for this iteration
-						if i == 0:
-							# First stepper (reference)
-							first_trigger = trigger_height
-							iteration_results[name].append(0.0)  # Always 0 for reference
-						else:
-							# Calculate offset relative to first stepper
-							offset = first_trigger - trigger_height
-							iteration_results[name].append(offset)
-							
-						if self.debug_mode:
-							if i == 0:
-								self._debug_log(
-									f"Reference height: {trigger_height:.3f}")
-							else:
-								self._debug_log(
-									f"Calculated offset: {offset:.3f}")
-					
-					except Exception as e:
-						# Re-enable all steppers before raising error
-						for s in self.z_steppers:
-							s.set_trapq(toolhead.get_trapq())
-						raise self.printer.command_error(
-							f"Error in iteration {iteration + 1} probing {name}: {str(e)}")
-				
-				# Re-enable all steppers after iteration
-				for s in self.z_steppers:
-					s.set_trapq(toolhead.get_trapq())
+						self._debug_log(
+							f"{name} (iteration {iteration + 1}) offset: {offset:.3f}")
 					
 			# Calculate final offsets
 			final_offsets = {}
@@ -856,6 +2173,45 @@ class PowerLossRecovery:
 				self._debug_log(f"Error in probe iterations: {str(e)}")
 			raise
 	
+	def _trace(self, kind, **fields):
+		"""Add an event to the trace of the running PLR_Z_HOME"""
+		if self.probe_trace is not None:
+			self.probe_trace.add(kind, **fields)
+	
+	def _start_probe_trace(self, mode):
+		if not self.probe_trace_file:
+			self.probe_trace = None
+			return
+		settings = {
+			'fast_move_speed': self.fast_move_speed,
+			'slow_homing_speed': self.slow_homing_speed,
+			'retract_dist': self.retract_dist,
+			'sample_retract_dist': self.sample_retract_dist,
+			'sample_size': self.sample_count,
+			'sampling_mode': self.sampling_mode,
+			'samples_min': self.samples_min,
+			'samples_tolerance': self.samples_tolerance,
+			'probe_samples_range': self.probe_samples_range,
+			'stepper_probing': self.stepper_probing,
+			'probe_iteration_count': self.probe_iteration_count,
+			'steppers': list(self.stepper_names),
+		}
+		self.probe_trace = ProbeTrace(self.reactor.monotonic, mode, settings)
+	
+	def _finish_probe_trace(self, error=None):
+		"""Append the trace of the finished PLR_Z_HOME run to probe_trace_file"""
+		trace, self.probe_trace = self.probe_trace, None
+		if trace is None:
+			return
+		try:
+			trace.write(self.probe_trace_file,
+						phases={name: round(t, 4) for name, t in self.z_home_timer.times.items()},
+						total=round(self.z_home_timer.total(), 4),
+						offsets={name: round(o, 5) for name, o in self.z_offsets.items()},
+						error=error)
+		except Exception as e:
+			logging.info(f"PowerLossRecovery: Error writing probe trace: {str(e)}")
+	
 	def _debug_log(self, message):
 		"""
 		Output debug messages to both the printer console and klippy log
@@ -872,28 +2228,14 @@ class PowerLossRecovery:
 		# Log to klippy.log
 		#logging.info(formatted_msg)
 		
+		# The console is only accessible from the reactor thread
+		if threading.current_thread() is not threading.main_thread():
+			logging.info(formatted_msg)
+			return
+		
 		# Output to printer console
 		self.gcode.respond_info(formatted_msg)
 	
-	def _save_endstop_position(self, name, position):
-		"""Save an endstop position to the variables file"""
-		if not self.save_variables:
-			return
-			
-		try:
-			var_name = f"z_endstop_position_{name}"
-			save_cmd = self.gcode.create_gcode_command(
-				"SAVE_VARIABLE", "SAVE_VARIABLE",
-				{"VARIABLE": var_name, "VALUE": list(position)})
-			self.save_variables.cmd_SAVE_VARIABLE(save_cmd)
-			
-			if self.debug_mode:
-				self._debug_log(
-					f"Saved {name} position: {position[0]:.3f}, {position[1]:.3f}, {position[2]:.3f}")
-		except Exception as e:
-			raise self.printer.command_error(
-				f"Error saving position for {name}: {str(e)}")
-	
 	def _restore_fan_speeds(self, state_data):
 		"""Restore part cooling fan speeds from saved state"""
 		try:
@@ -990,7 +2332,7 @@ class PowerLossRecovery:
 				raise self.printer.command_error("Must home Z first")
 				
 			# Load and display current offsets
-			saved_offsets = self._load_saved_z_offsets()
+			saved_offsets = self._get_z_calibration(reload=True)['offsets']
 			gcmd.respond_info("Stored offsets:")
 			for name, offset in saved_offsets.items():
 				gcmd.respond_info(f"{name}: {offset:.3f}")
@@ -1002,6 +2344,54 @@ class PowerLossRecovery:
 		except Exception as e:
 			raise self.printer.command_error(f"Error testing offsets: {str(e)}")
 	
+	def _run_operation_gcode(self, toolhead, lines):
+		"""Run before/after G-code lines as configured by operation_gcode_wait"""
+		if self.operation_gcode_wait == 'block':
+			# Heating and moves of different lines can overlap
+			self.gcode.run_script_from_command("\n".join(lines))
+			toolhead.wait_moves()
+			return
+		for line in lines:
+			self.gcode.run_script_from_command(line)
+			toolhead.wait_moves()
+	
+	cmd_PLR_CALIBRATION_HISTORY_help = "Show recent PLR_Z_HOME CALIBRATE results and their drift. COUNT=<results>"
+	def cmd_PLR_CALIBRATION_HISTORY(self, gcmd):
+		history = self._get_calibration_history()
+		if history is None:
+			raise gcmd.error("Calibration history is disabled (calibration_history_size: 0)")
+		count = gcmd.get_int('COUNT', 10, minval=1)
+		entries = history.entries()[-count:]
+		if not entries:
+			gcmd.respond_info("No calibration results recorded")
+			return
+		
+		names = list(self.stepper_names)
+		msg = [f"Last {len(entries)} of {len(history.entries())} calibrations:"]
+		for entry in entries:
+			when = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['time']))
+			endstop_z = entry.get('endstop_z')
+			line = [when, f"endstop Z {endstop_z:.3f}" if endstop_z is not None else "endstop Z -"]
+			for name in names:
+				if name in entry['offsets']:
+					spread = entry.get('spread', {}).get(name, 0.)
+					samples = entry.get('samples', {}).get(name, 0)
+					line.append(f"{name} {entry['offsets'][name]:+.4f} (sd {spread:.4f}, n={samples})")
+			msg.append("  ".join(line))
+		
+		drift = history.drift(len(entries))
+		if drift:
+			msg.append("Drift (max - min): " + ", ".join(
+				f"{name} {value:.4f}mm" for name, value in drift.items()))
+		stable = self.calibration_stable
+		if stable is None:
+			msg.append(f"Stability: needs {self.calibration_stable_runs} calibrations")
+		else:
+			msg.append(f"Stability: {'stable' if stable else 'drifting'} over the last "
+					   f"{self.calibration_stable_runs} calibrations "
+					   f"(range {self.calibration_stable_range:.3f}mm)")
+		gcmd.respond_info("\n".join(msg))
+	
 	cmd_PLR_Z_HOME_help = "Home Z axis with multiple endstops. MODE=CALIBRATE to measure and save offsets, MODE=RESUME to use saved offsets"
 	def cmd_PLR_Z_HOME(self, gcmd):
 		mode = gcmd.get('MODE', 'CALIBRATE').upper()
@@ -1011,20 +2401,29 @@ class PowerLossRecovery:
 		toolhead = self.printer.lookup_object('toolhead')
 		curtime = self.printer.get_reactor().monotonic()
 		
+		# Prepare the resume file while homing
+		if mode == 'RESUME':
+			try:
+				state_data = self._get_saved_state()
+				if state_data:
+					self._start_resume_prep(state_data)
+			except Exception as e:
+				if self.debug_mode:
+					self._debug_log(f"Could not start resume preparation: {str(e)}")
+		
 		# Execute pre-operation G-code based on mode
+		self.z_home_timer = PhaseTimer(self.reactor.monotonic)
+		self._start_probe_trace(mode)
+		self.z_home_timer.start('pre_gcode')
 		try:
 			if mode == 'RESUME' and self.before_resume_gcode_lines:
 				if self.debug_mode:
 					self._debug_log("Executing before-resume G-code commands...")
-				for line in self.before_resume_gcode_lines:
-					self.gcode.run_script_from_command(line)
-					toolhead.wait_moves()
+				self._run_operation_gcode(toolhead, self.before_resume_gcode_lines)
 			elif mode == 'CALIBRATE' and self.before_calibrate_gcode_lines:
 				if self.debug_mode:
 					self._debug_log("Executing before-calibrate G-code commands...")
-				for line in self.before_calibrate_gcode_lines:
-					self.gcode.run_script_from_command(line)
-					toolhead.wait_moves()
+				self._run_operation_gcode(toolhead, self.before_calibrate_gcode_lines)
 		except Exception as e:
 			raise self.printer.command_error(
 				f"Error executing pre-operation G-code: {str(e)}")
@@ -1032,6 +2431,11 @@ class PowerLossRecovery:
 		if 'z' not in toolhead.get_status(curtime)['homed_axes']:
 			raise self.printer.command_error("Must home Z first")
 		
+		# Read the saved calibration once for the whole operation
+		self._get_z_calibration(reload=True)
+		self._calibration_endstop_position = None
+		self.probe_noise = {}
+		
 		try:
 			if self.debug_mode:
 				self._debug_log(f"\nStarting PLR Z Home in {mode} mode")
@@ -1047,6 +2451,7 @@ class PowerLossRecovery:
 				self._debug_log("\nPerforming initial probe with first endstop")
 			
 			# Record starting position
+			self.z_home_timer.start('initial_probe')
 			initial_pos = toolhead.get_position()
 			if self.debug_mode:
 				self._debug_log(f"Initial position: X{initial_pos[0]:.3f} Y{initial_pos[1]:.3f} Z{initial_pos[2]:.3f}")
@@ -1058,7 +2463,6 @@ class PowerLossRecovery:
 				if self.debug_mode:
 					self._debug_log(f"Fast travel to Z={fast_pos[2]:.3f} at {self.fast_travel_speed} mm/s")
 				toolhead.manual_move(fast_pos, self.fast_travel_speed)
-				toolhead.wait_moves()
 			
 			# Perform initial probe
 			initial_endstop = self.endstops[0]
@@ -1066,12 +2470,12 @@ class PowerLossRecovery:
 			probe_pos[2] = self.position_endstop
 			
 			try:
-				measured_pos = self.printer.lookup_object('homing').probing_move(
-					initial_endstop, probe_pos, self.fast_move_speed)
+				measured_pos, _ = self._endstops_probing_move(
+					[(initial_endstop, self.stepper_names[0])], probe_pos, self.fast_move_speed)
 				
 				if  mode == 'CALIBRATE':
-					# Save initial probe position
-					self._save_endstop_position('stepper_z', measured_pos)
+					# Saved with the offsets once the calibration completed
+					self._calibration_endstop_position = list(measured_pos)
 					
 				if self.debug_mode:
 					self._debug_log(f"Initial probe trigger at Z={measured_pos[2]:.3f}")
@@ -1087,126 +2491,76 @@ class PowerLossRecovery:
 			retract_pos = list(measured_pos)
 			retract_pos[2] -= self.retract_dist
 			toolhead.manual_move(retract_pos, self.fast_move_speed)
-			toolhead.wait_moves()
 			
 			reference_z = retract_pos[2]  # Save this height for returning between probes
 			
 			if self.halt_after_initial_probe:
+				if mode == 'CALIBRATE':
+					self._save_z_calibration({}, self._calibration_endstop_position)
 				self._debug_log(
 					"Initial Z probe completed. Halting as requested.")
+				self.z_home_timer.stop()
+				self._finish_probe_trace()
 				return
 			
-			# Individual stepper probing
-			self._debug_log("\nStarting individual stepper probing...")
-			
-			for i, (stepper, endstop, name) in enumerate(zip(
-				self.z_steppers, self.endstops, self.stepper_names)):
-				
+			# Skip the per stepper probing on resume unless the saved offsets drifted
+			cached_offsets = None
+			if mode == 'RESUME' and self.fast_resume_homing:
+				cached_offsets, reason = self._check_cached_calibration(
+					measured_pos[2] - initial_pos[2])
+				if cached_offsets is None:
+					gcmd.respond_info(f"PLR: Full Z probing required, {reason}")
+			if cached_offsets is not None:
+				self.z_offsets.update(cached_offsets)
 				if self.debug_mode:
-					self._debug_log(f"\nProbing {name} (stepper {i+1} of {len(self.z_steppers)})")
-				
-				# Disable all steppers except the current one
-				for s in self.z_steppers:
-					s.set_trapq(None)
-				stepper.set_trapq(toolhead.get_trapq())
-				
-				# Ensure movement has settled
-				toolhead.dwell(0.500)  # 100ms pause
-				
-				try:
-					# Probe this stepper
-					trigger_height = self._probe_single_stepper(
-						stepper, endstop, name, reference_z)
-					
-					# Store raw trigger height results
-					if i == 0:
-						# First stepper (reference)
-						first_trigger = trigger_height
-						self.z_offsets[name] = 0.0  # Reference stepper always has 0 offset
-					else:
-						# Calculate offset relative to first stepper without adjustment
-						base_offset = first_trigger - trigger_height
-						self.z_offsets[name] = base_offset
-						
-					# Save offset only in CALIBRATE mode
-					if mode == 'CALIBRATE':
-						self._save_z_offset(name, self.z_offsets[name])
-					
-					if self.debug_mode:
-						self._debug_log(f"{name} final offset: {self.z_offsets[name]:.3f}mm")
-					
-				except Exception as e:
-					# Re-enable all steppers before raising error
-					for s in self.z_steppers:
-						s.set_trapq(toolhead.get_trapq())
-					raise self.printer.command_error(
-						f"Error probing {name}: {str(e)}")
-			
-			# Re-enable all steppers
-			for s in self.z_steppers:
-				s.set_trapq(toolhead.get_trapq())
-			
-			# Store initial offsets after first probing round
-			initial_offsets = self.z_offsets.copy()
+					self._debug_log("\nSaved stepper offsets still valid, skipping individual probing")
+			else:
+				self._probe_z_steppers(toolhead, mode, reference_z)
 			
-			if self.probe_iteration_count > 1 and mode == 'CALIBRATE':
-				if self.debug_mode:
-					self._debug_log(
-						f"\nStarting additional {self.probe_iteration_count} probe iterations")
-				
-				try:
-					# Perform iterative probing and get final offsets
-					final_offsets = self._probe_with_iterations(toolhead, initial_offsets)
-					
-					# Update z_offsets with final calculated values
-					self.z_offsets.update(final_offsets)
-					
-					# Save final offsets if in CALIBRATE mode
-					if mode == 'CALIBRATE':
-						for name, offset in self.z_offsets.items():
-							self._save_z_offset(name, offset)
-							
-				except Exception as e:
-					raise self.printer.command_error(
-						f"Error during probe iterations: {str(e)}")
-						
 			# Final homing sequence
+			self.z_home_timer.start('final_home')
 			self._debug_log("\nStarting final homing sequence...")
 			
 			# Return to reference height
 			return_pos = list(toolhead.get_position())
 			return_pos[2] = reference_z
 			toolhead.manual_move(return_pos, self.slow_homing_speed)
-			toolhead.wait_moves()
 			
 			# 3. Final home at slow speed
-			measured_pos = self.printer.lookup_object('homing').probing_move(
-				self.endstops[0], probe_pos, self.slow_homing_speed)
+			measured_pos, _ = self._endstops_probing_move(
+				[(self.endstops[0], self.stepper_names[0])], probe_pos, self.slow_homing_speed)
 		
 			
 			# Apply Z offsets for all steppers
+			self.z_home_timer.start('apply_offsets')
 			try:
-				if self.debug_mode:
-					self._debug_log("\nApplying Z offsets for all steppers")
-				self._apply_z_offsets(toolhead, stepper_name=None, mode=mode)
+				if cached_offsets is not None:
+					# The steppers moved together since the last homing and
+					# kept its alignment, an offset move would tilt the gantry
+					self._reset_kinematic_z(self._get_z_calibration()['endstop_position'])
+				else:
+					if self.debug_mode:
+						self._debug_log("\nApplying Z offsets for all steppers")
+					self._apply_z_offsets(toolhead, stepper_name=None, mode=mode)
 			except Exception as e:
 				raise self.printer.command_error(
 					f"Error applying Z offsets: {str(e)}")
 			
+			if mode == 'CALIBRATE':
+				self._save_z_calibration(self.z_offsets, self._calibration_endstop_position)
+				self._record_calibration(self._calibration_endstop_position)
+			
+			self.z_home_timer.start('post_gcode')
 			try:
 				# Execute post-operation G-code based on mode
 				if mode == 'RESUME' and self.after_resume_gcode_lines:
 					if self.debug_mode:
 						self._debug_log("Executing after-resume G-code commands...")
-					for line in self.after_resume_gcode_lines:
-						self.gcode.run_script_from_command(line)
-						toolhead.wait_moves()
+					self._run_operation_gcode(toolhead, self.after_resume_gcode_lines)
 				elif mode == 'CALIBRATE' and self.after_calibrate_gcode_lines:
 					if self.debug_mode:
 						self._debug_log("Executing after-calibrate G-code commands...")
-					for line in self.after_calibrate_gcode_lines:
-						self.gcode.run_script_from_command(line)
-						toolhead.wait_moves()
+					self._run_operation_gcode(toolhead, self.after_calibrate_gcode_lines)
 			except Exception as e:
 				# Log error but don't fail the operation
 				if self.debug_mode:
@@ -1227,6 +2581,13 @@ class PowerLossRecovery:
 				
 				self.resuming_print = False  # Ensure flag is set before you start printing.
 			
+			# Report once all queued homing moves completed
+			toolhead.wait_moves()
+			self.z_home_timer.stop()
+			self._finish_probe_trace()
+			gcmd.respond_info(f"PLR Z Home ({mode}) took {self.z_home_timer.total():.1f}s: "
+							  f"{self.z_home_timer.report()}")
+			
 			# Success message with results
 			msg = [f"\nPLR Z Home ({mode} mode) completed successfully:"]
 			msg.append("Final Z offsets:")
@@ -1245,6 +2606,8 @@ class PowerLossRecovery:
 			msg = str(e)
 			if self.debug_mode:
 				self._debug_log(f"Error in Z calibration: {str(e)}")
+			self.z_home_timer.stop()
+			self._finish_probe_trace(error=msg)
 			# Ensure all steppers are re-enabled
 			try:
 				for s in self.z_steppers:
@@ -1406,6 +2769,38 @@ class PowerLossRecovery:
 				logging.info(f"Error optimizing interval: {str(e)}")
 			return self.save_interval
 
+	def _check_save_policy(self, current_state: Optional[Dict[str, Any]]) -> Optional[bool]:
+		"""
+		Decide on a save based on the progress made since the last saved state.
+		Returns True to force a save, False to skip it, or None to leave the
+		decision to the time based interval.
+		"""
+		if not current_state:
+			return None
+		file_position = current_state['file_progress']['position']
+		print_time = current_state.get('print_time', 0.)
+		if self._last_saved_progress is None:
+			saved_position, saved_print_time = 0, print_time
+		else:
+			saved_position, saved_print_time = self._last_saved_progress
+		progressed_bytes = file_position - saved_position
+		progressed_time = print_time - saved_print_time
+
+		# Little progress (heating, long single moves) - a save would not
+		# move the resume point meaningfully
+		if self.save_min_bytes and progressed_bytes < self.save_min_bytes:
+			return False
+		if self.save_max_bytes and progressed_bytes >= self.save_max_bytes:
+			if self.debug_mode:
+				logging.info(f"PowerLossRecovery: {progressed_bytes} bytes since last save - forcing save")
+			return True
+		if (self.save_max_print_time and progressed_bytes > 0
+				and progressed_time >= self.save_max_print_time):
+			if self.debug_mode:
+				logging.info(f"PowerLossRecovery: {progressed_time:.1f}s print time since last save - forcing save")
+			return True
+		return None
+
 	def _collect_current_state(self) -> Dict[str, Any]:
 		  try:
 			  # Get single eventtime for all status queries
@@ -1469,6 +2864,12 @@ class PowerLossRecovery:
 					  xyz_offsets = {'x': 0., 'y': 0., 'z': 0.}
 					  if self.debug_mode:
 						  logging.info("PowerLossRecovery: Could not get gcode_move object for XYZ offsets")
+				  
+				  # Objects cancelled with EXCLUDE_OBJECT
+				  excluded_objects = []
+				  exclude_object = self.printer.lookup_object('exclude_object', None)
+				  if exclude_object is not None:
+					  excluded_objects = list(exclude_object.get_status(eventtime).get('excluded_objects', []))
 
 				  # Compile synchronized state information
 				  state_info = {
@@ -1487,6 +2888,8 @@ class PowerLossRecovery:
 					  'bed_temp': round(float(bed_temp), 1),
 					  'save_time': eventtime,
 					  'current_file': current_file,
+					  'excluded_objects': excluded_objects,
+					  'print_time': round(float(toolhead_status.get('print_time', 0.)), 3),
 					  'collection_time': eventtime  # Add timestamp for verification
 				  }
 				  
@@ -1522,46 +2925,82 @@ class PowerLossRecovery:
 				self._debug_log(f"Error getting move buffer status: {str(e)}")
 			return {'moves_pending': 0, 'min_move_time': 0, 'max_move_time': 0}
 	
-	def _calculate_optimal_delay(self) -> int:
+	def _position_marker_task(self, eventtime):
+		"""
+		Periodically tag the lookahead queue with the current file position.
+		The toolhead calls back with the print_time at which all moves queued
+		so far are flushed, which gives a print_time -> file offset mapping.
+		"""
 		try:
-			toolhead = self.printer.lookup_object('toolhead')
-			reactor = self.printer.get_reactor()
-			mcu = self.printer.lookup_object('mcu')
-			eventtime = reactor.monotonic()
-			print_time = toolhead.get_last_move_time()
-			est_print_time = mcu.estimated_print_time(eventtime)
-			
-			# Calculate MCU lag
-			mcu_lag = print_time - est_print_time
-			
-			# Calculate how many save_intervals we need to cover the MCU lag
-			needed_intervals = max(1, int(mcu_lag / self.save_interval) + 1)
-			
-			# Calculate optimal delay to cover the lag
-			optimal_delay = needed_intervals
-			
-			if self.debug_mode:
-				self._debug_log(
-					f"Delay calculation:\n"
-					f"  Print time: {print_time:.3f}\n"
-					f"  Est print time: {est_print_time:.3f}\n"
-					f"  MCU lag: {mcu_lag:.3f}s\n"
-					f"  Save interval: {self.save_interval}s\n"
-					f"  Needed intervals: {needed_intervals}\n"
-					f"  Total time lag: {mcu_lag + (optimal_delay * self.save_interval):.3f}s\n"
-					f"  Final delay: {optimal_delay} (base: {self.save_delay})"
-				)
-				
-			return min(optimal_delay, self.history_size - 1)
-			
+			if not self.is_active or self.virtual_sdcard is None:
+				self._position_markers.clear()
+				self._last_marker_position = None
+				return eventtime + 1.0
+			file_position = self.virtual_sdcard.get_status(eventtime).get('file_position', 0)
+			if file_position != self._last_marker_position:
+				self._last_marker_position = file_position
+				position = [round(float(p), 3) for p in self.toolhead.get_position()[:3]]
+				def note_flushed(print_time, file_position=file_position, position=position):
+					self._position_markers.append((print_time, file_position, position))
+				self.toolhead.register_lookahead_callback(note_flushed)
 		except Exception as e:
 			if self.debug_mode:
-				self._debug_log(f"Error calculating optimal delay: {str(e)}")
-			return self.save_delay
+				logging.info(f"PowerLossRecovery: Error registering position marker: {str(e)}")
+		return eventtime + self.position_marker_interval
 
+	def _get_executed_progress(self, eventtime) -> Optional[Tuple[float, int, list]]:
+		"""
+		Return the (print_time, file_position, position) marker of the last
+		move the MCU has actually executed, or None if no marker is known yet.
+		"""
+		if not self._position_markers or self.mcu is None:
+			return None
+		est_print_time = self.mcu.estimated_print_time(eventtime)
+		markers = self._position_markers
+		# Markers are appended in print_time order; drop the ones superseded
+		# by a later executed marker
+		while len(markers) >= 2 and markers[1][0] <= est_print_time:
+			markers.popleft()
+		if markers[0][0] > est_print_time:
+			return None
+		return markers[0]
 
+	def _select_state_to_save(self) -> Optional[Dict[str, Any]]:
+		"""
+		Build the state to persist. Uses the MCU executed file position when
+		available and falls back to the delayed entry from the state history.
+		"""
+		if self.track_executed_position and self.state_history:
+			executed = self._get_executed_progress(self.reactor.monotonic())
+			if executed is not None:
+				print_time, file_position, position = executed
+				state = dict(self.state_history[-1])
+				file_size = state['file_progress']['total_size']
+				progress = (file_position / file_size * 100) if file_size > 0 else 0
+				state['file_progress'] = {
+					'position': file_position,
+					'total_size': file_size,
+					'progress_pct': round(progress, 2)
+				}
+				state['position'] = {'x': position[0], 'y': position[1], 'z': position[2]}
+				state['print_time'] = round(print_time, 3)
+				state['position_source'] = 'mcu'
+				return state
+		if len(self.state_history) > self.save_delay:
+			state = dict(self.state_history[-(self.save_delay + 1)])
+			state['position_source'] = 'history'
+			return state
+		if self.debug_mode:
+			logging.info(f"PowerLossRecovery: Not enough history ({len(self.state_history)} states) "
+					   f"to save delayed state (need {self.save_delay + 1})")
+		return None
 
-	def _save_current_state(self):
+	def _save_current_state(self, reason='interval'):
+		"""
+		Save the current print state. Layer changes, extruder changes and
+		manual saves are the most valuable for recovery and may use the
+		reserved part of the write budget.
+		"""
 		if not self.is_active:
 			if self.debug_mode:
 				logging.info("PowerLossRecovery: Not saving state - printer not active")
@@ -1583,17 +3022,8 @@ class PowerLossRecovery:
 			return
 		
 		try:
-			# Get the delayed state from history
-			#if len(self.state_history) > self.save_delay:
-			
-			optimal_delay = self._calculate_optimal_delay()
-			
-			if len(self.state_history) > optimal_delay:
-				
-				# Convert deque to list for easier indexing from end
-				history_list = list(self.state_history)
-				state_to_save = history_list[-(self.save_delay + 1)]
-				
+			state_to_save = self._select_state_to_save()
+			if state_to_save is not None:
 				# Add buffer status to saved state
 				buffer_status = self._get_move_buffer_status()
 				state_to_save['mcu_status'] = buffer_status
@@ -1611,28 +3041,117 @@ class PowerLossRecovery:
 					logging.info(f"PowerLossRecovery: Saving synchronized state from time {collection_time:.2f} "
 							   f"at {progress_info.get('progress_pct', 0):.2f}% completion")
 				
+				# Enforce the flash wear budget
+				eventtime = self.reactor.monotonic()
+				expected_bytes = self._get_variables_file_size()
+				if self.write_budget.is_limited() and reason != 'manual':
+					high_priority = reason in ('layer', 'extruder')
+					if not self.write_budget.allows(eventtime, expected_bytes, high_priority):
+						self.budget_skipped_saves += 1
+						if self.debug_mode:
+							logging.info(f"PowerLossRecovery: Write budget exhausted - skipping {reason} save")
+						return
+				self.write_budget.consume(eventtime, expected_bytes)
+				
 				# Save to variables file
 				state_json = json.dumps(state_to_save)
-				escaped_json = state_json.replace('"', '\\"')
-				self.gcode.run_script_from_command(
-					f'SAVE_VARIABLE VARIABLE=resume_meta_info VALUE="{escaped_json}"')
+				if self.state_writer is not None:
+					# Update in memory and let the writer thread persist it
+					self._set_variable('resume_meta_info', json.loads(state_json))
+					self.state_writer.submit()
+				else:
+					save_start = self.reactor.monotonic()
+					self._set_variable('plr_lifetime_bytes_written',
+									   self.save_stats.get_lifetime_bytes())
+					escaped_json = state_json.replace('"', '\\"')
+					self.gcode.run_script_from_command(
+						f'SAVE_VARIABLE VARIABLE=resume_meta_info VALUE="{escaped_json}"')
+					self.save_stats.record_save(self.reactor.monotonic() - save_start,
+												self._get_variables_file_size())
 				
 				self.last_save_time = self.reactor.monotonic()
+				self._last_saved_progress = (state_to_save['file_progress']['position'],
+											 state_to_save.get('print_time', 0.))
 				self._consecutive_failures = 0
 				
 				if self.debug_mode:
 					logging.info("PowerLossRecovery: Successfully saved synchronized state")
-			else:
-				if self.debug_mode:
-					logging.info(f"PowerLossRecovery: Not enough history ({len(self.state_history)} states) "
-							   f"to save delayed state (need {self.save_delay + 1})")
 				
 		except Exception as e:
+			self.save_stats.record_failure()
 			logging.exception("PowerLossRecovery: Error saving printer state")
 			if self.debug_mode:
 				logging.info(f"Error saving printer state: {str(e)}")
 		  
 
+	def _set_variable(self, name: str, value: Any):
+		"""Update a save_variables value in memory (copy on write)"""
+		variables = dict(self.save_variables.allVariables)
+		variables[name] = value
+		self.save_variables.allVariables = variables
+
+	def _store_variable(self, name: str, value: Any):
+		"""Persist a save_variables value, through the state writer if it runs"""
+		if self.state_writer is not None:
+			self._set_variable(name, value)
+			self.state_writer.submit()
+			return
+		save_cmd = self.gcode.create_gcode_command(
+			"SAVE_VARIABLE", "SAVE_VARIABLE", {"VARIABLE": name, "VALUE": repr(value)})
+		self.save_variables.cmd_SAVE_VARIABLE(save_cmd)
+
+	cmd_SAVE_VARIABLE_help = "Save arbitrary variables to disk"
+	def cmd_SAVE_VARIABLE(self, gcmd):
+		"""Replaces save_variables' SAVE_VARIABLE while the state writer runs"""
+		varname = gcmd.get('VARIABLE')
+		value = gcmd.get('VALUE')
+		try:
+			value = ast.literal_eval(value)
+		except (ValueError, SyntaxError):
+			raise gcmd.error(f"Unable to parse '{value}' as a literal")
+		self._store_variable(varname, value)
+
+	def _snapshot_variables(self) -> Dict[str, Any]:
+		"""
+		Copy of the variables to write. The lifetime byte count covers the
+		completed writes, this one is added once it succeeded.
+		"""
+		variables = dict(self.save_variables.allVariables)
+		variables['plr_lifetime_bytes_written'] = self.save_stats.get_lifetime_bytes()
+		return variables
+
+	def _get_variables_file_size(self) -> int:
+		try:
+			return os.path.getsize(self.save_variables.filename)
+		except Exception:
+			return 0
+
+	def get_status(self, eventtime):
+		status = {
+			'enabled': self.power_loss_recovery_enabled,
+			'active': self.is_active,
+			'history_depth': len(self.state_history),
+			'save_interval': round(self._current_interval, 2),
+			'background_save': self.state_writer is not None,
+		}
+		status.update(self.save_stats.get_stats())
+		status.update(self.write_budget.get_status())
+		status['budget_skipped_saves'] = self.budget_skipped_saves
+		if self.state_writer is not None:
+			stats = self.state_writer.get_stats()
+			status.update({
+				'save_pending': stats['pending'],
+				'save_latency': stats['last_latency'],
+				'save_latency_avg': stats['avg_latency'],
+				'save_latency_max': stats['max_latency'],
+				'saves_dropped': stats['dropped_count'],
+			})
+		status['probe_noise'] = self.probe_noise
+		status['calibration_stable'] = self.calibration_stable
+		status['z_home_phase_times'] = {name: round(duration, 3) for name, duration
+										in self.z_home_timer.times.items()}
+		return status
+
 	def _background_task(self, eventtime):
 		try:
 			# Previous state tracking
@@ -1649,6 +3168,7 @@ class PowerLossRecovery:
 					if self.debug_mode:
 						logging.info("PowerLossRecovery: Print started - activating")
 					self.state_history.clear()
+					self._last_saved_progress = None
 					consecutive_failures = 0
 				else:
 					if self.debug_mode:
@@ -1661,12 +3181,15 @@ class PowerLossRecovery:
 					
 				# Collect current state
 				current_state = self._collect_current_state()
+				policy_decision = None
 				if current_state:
 					# Verify state before adding to history
 					is_valid, error_msg = self._verify_state(current_state)
 					if is_valid:
 						self.state_history.append(current_state)
 						consecutive_failures = 0
+						if self.save_min_bytes or self.progress_policy_enabled:
+							policy_decision = self._check_save_policy(current_state)
 						if self.debug_mode:
 							logging.info(
 								f"PowerLossRecovery: Collected valid state "
@@ -1684,7 +3207,10 @@ class PowerLossRecovery:
 				if self.time_based_enabled:
 					time_since_last = eventtime - self.last_save_time
 					interval = self._optimize_background_interval()
+					self._current_interval = interval
 					should_save = time_since_last >= interval
+				if policy_decision is not None:
+					should_save = policy_decision
 				
 				# Implement exponential backoff for failures
 				if consecutive_failures > 0:
@@ -1700,7 +3226,15 @@ class PowerLossRecovery:
 			self._consecutive_failures = consecutive_failures
 			
 			# Calculate next wake time
-			if not self.time_based_enabled or not printing:
+			if not printing:
+				return eventtime + 1.0
+			if self.progress_policy_enabled:
+				# Poll progress often enough to honour the max save window
+				interval = self.progress_check_interval
+				if self.time_based_enabled:
+					interval = min(interval, self._optimize_background_interval())
+				return eventtime + interval
+			if not self.time_based_enabled:
 				return eventtime + 1.0
 			
 			# Use optimized interval
@@ -1731,7 +3265,7 @@ class PowerLossRecovery:
 			
 			if self.debug_mode:
 				logging.info(f"PowerLossRecovery: Layer changed to {self.last_layer}")
-			self._save_current_state()
+			self._save_current_state('layer')
 			
 			# Trigger the next background task immediately if active
 			if self.is_active and self.time_based_enabled:
@@ -1754,7 +3288,7 @@ class PowerLossRecovery:
 			
 			if self.debug_mode:
 				logging.info("PowerLossRecovery: Extruder activation detected - saving state")
-			self._save_current_state()
+			self._save_current_state('extruder')
 			
 			# Trigger the next background task immediately if active
 			if self.is_active and self.time_based_enabled:
@@ -1781,26 +3315,52 @@ class PowerLossRecovery:
 			self.toolhead = self.printer.lookup_object('toolhead')
 			self.extruder = self.printer.lookup_object('extruder')
 			self.heater_bed = self.printer.lookup_object('heater_bed', None)
+			self.mcu = self.printer.lookup_object('mcu')
+			self.virtual_sdcard = self.printer.lookup_object('virtual_sdcard', None)
 			
 			if self.debug_mode:
 				logging.info("PowerLossRecovery: Ready state - starting background task")
 			
 			# Start periodic timer with immediate first run
 			self.reactor.register_timer(self._background_task, self.reactor.NOW)
+			if self.track_executed_position:
+				self.reactor.register_timer(self._position_marker_task, self.reactor.NOW)
+			
+			if self.save_variables is not None:
+				# Continue the lifetime byte count of earlier sessions
+				self.save_stats.set_lifetime_bytes(int(
+					self.save_variables.allVariables.get('plr_lifetime_bytes_written', 0)))
+			if self.background_save and self.save_variables is not None:
+				self.state_writer = StateWriter(self.save_variables.filename,
+												self._snapshot_variables,
+												self.save_stats)
+				self.state_writer.start()
+				# The writer must be the only writer of the variables file,
+				# a direct write could be replaced by an older queued snapshot
+				self.gcode.register_command('SAVE_VARIABLE', None)
+				self.gcode.register_command('SAVE_VARIABLE', self.cmd_SAVE_VARIABLE,
+											desc=self.cmd_SAVE_VARIABLE_help)
+			
+			# Read the calibration history here instead of on the first get_status
+			if self.save_variables is not None:
+				self._update_calibration_stable()
 			
 		except Exception as e:
 			logging.exception("Error during PowerLossRecovery ready state")
 			raise
 			
 	
+	def _handle_disconnect(self):
+		# Flush the last pending state before shutting down
+		if self.state_writer is not None:
+			self.state_writer.stop()
+	
 	def _reset_state(self):
 		if self.save_variables is None:
 			return
 			
 		try:
-			empty_state = json.dumps({})
-			self.gcode.run_script_from_command(
-				f'SAVE_VARIABLE VARIABLE=resume_meta_info VALUE="{empty_state}"')
+			self._store_variable('resume_meta_info', {})
 			self.last_layer = 0
 			self.last_save_time = 0
 			if self.debug_mode:
@@ -1820,11 +3380,14 @@ class PowerLossRecovery:
 		msg.append(f"Layer-based saving: {'Enabled (current layer: %d)' % self.last_layer if self.save_on_layer else 'Disabled'}")
 		msg.append(f"History size: {self.history_size} (current: {len(self.state_history)})")
 		msg.append(f"Save delay: {self.save_delay} states")
+		msg.append(f"Executed position tracking: {'Enabled' if self.track_executed_position else 'Disabled'}")
+		if self.save_min_bytes or self.progress_policy_enabled:
+			msg.append(f"Progress policy: min {self.save_min_bytes} bytes, max {self.save_max_bytes} bytes, "
+					   f"max {self.save_max_print_time:.0f}s print time")
 		
 		try:
-			val = self.save_variables.get_stored_variable('resume_meta_info')
-			if val:
-				saved_data = json.loads(val)
+			saved_data = self._get_saved_state()
+			if saved_data:
 				progress_info = saved_data.get('file_progress', {})
 				collection_time = saved_data.get('collection_time', 0)
 				msg.extend([
@@ -1845,11 +3408,25 @@ class PowerLossRecovery:
 		except Exception as e:
 			if self.debug_mode:
 				msg.append(f"\nError reading saved state: {str(e)}")
+		
+		status = self.get_status(self.reactor.monotonic())
+		msg.extend([
+			"",
+			"Save Statistics:",
+			f"Saves: {status['save_count']} (failures: {status['failure_count']})",
+			f"Save duration: avg {status['save_duration_avg'] * 1000.:.1f}ms, "
+			f"max {status['save_duration_max'] * 1000.:.1f}ms",
+			f"Current save interval: {status['save_interval']:.1f}s",
+			f"Bytes written (last hour): {status['bytes_written_per_hour']}",
+			f"Lifetime bytes written: {status.get('lifetime_bytes_written', 0)}",
+			f"Saves skipped by write budget: {status['budget_skipped_saves']}"
+		])
+		gcmd.respond_info("\n".join(msg))
 				
 						
 	cmd_PLR_SAVE_PRINT_STATE_help = "Manually save current printer state"
 	def cmd_PLR_SAVE_PRINT_STATE(self, gcmd):
-		self._save_current_state()
+		self._save_current_state('manual')
 		gcmd.respond_info("Printer state saved")
 		
 	cmd_PLR_RESET_PRINT_DATA_help = "Clear all saved state data"
@@ -1890,11 +3467,7 @@ class PowerLossRecovery:
 			if not profile_name:
 				raise self.printer.command_error("No bed mesh profile currently active")
 				
-			# Convert profile name to JSON string to handle literals properly
-			save_cmd = self.gcode.create_gcode_command(
-				"SAVE_VARIABLE", "SAVE_VARIABLE",
-				{"VARIABLE": "saved_mesh_profile", "VALUE": json.dumps(profile_name)})
-			self.save_variables.cmd_SAVE_VARIABLE(save_cmd)
+			self._store_variable('saved_mesh_profile', profile_name)
 			
 			if self.debug_mode:
 				self._debug_log(f"Saved bed mesh profile: {profile_name}")
@@ -2010,7 +3583,9 @@ class PowerLossRecovery:
 	def cmd_PLR_RESUME_PRINT(self, gcmd):
 		"""
 		Create a modified version of the last printed gcode file for power loss recovery.
-		The new file will start from the last saved position.
+		The new file will start from the last saved position. Uses the
+		artifact prepared by PLR_PREPARE_RESUME / PLR_Z_HOME MODE=RESUME if
+		it matches the saved state.
 		"""
 		try:
 			
@@ -2021,29 +3596,39 @@ class PowerLossRecovery:
 			if not state_data:
 				gcmd.respond_info("No valid saved state found")
 				return
-				
-			# Extract required information
-			current_file = state_data.get('current_file')
-			if not current_file:
-				gcmd.respond_info("No filename found in saved state")
+			
+			try:
+				input_file, current_file, file_position = self._get_resume_source(state_data)
+				job = self._start_resume_prep(state_data)
+			except self.printer.command_error as e:
+				gcmd.respond_info(str(e))
 				return
-				
-			file_progress = state_data.get('file_progress', {})
-			file_position = file_progress.get('position')
-			if file_position is None:
-				gcmd.respond_info("No file position found in saved state")
+			
+			if not job.is_done():
+				gcmd.respond_info("Waiting for resume preparation to finish")
+			self._wait_resume_prep(job)
+			self._resume_prep = None
+			if job.error is not None:
+				gcmd.respond_info(f"Error preparing resume: {job.error}")
 				return
-				
-			# Get gcode directory from config and construct full file path
-			gcode_dir = self._get_gcode_dir()
-			input_file = os.path.join(gcode_dir, current_file)
+			if self.debug_mode:
+				self._debug_log(f"Resume preparation took {job.duration:.2f}s")
 			
-			if not os.path.exists(input_file):
-				gcmd.respond_info(f"Original gcode file not found: {input_file}")
+			if self.resume_mode == 'virtual':
+				if job.result is None:
+					gcmd.respond_info("Required PLR_RESUME placeholders not found in gcode file")
+					return
+				try:
+					self._start_virtual_resume(gcmd, state_data, current_file,
+											   file_position, job.result)
+				except Exception as e:
+					gcmd.respond_info(f"Error starting print: {str(e)}")
 				return
 				
-			# Modify the gcode file
-			output_file = self._modify_gcode_file(input_file, file_position)
+			# Replace the gcode file with the prepared copy
+			output_file = None
+			if job.result is not None:
+				output_file = self._install_resume_file(input_file, job.result)
 			if not output_file:
 				gcmd.respond_info("Error creating modified gcode file")
 				return
@@ -2058,6 +3643,7 @@ class PowerLossRecovery:
 				basename = os.path.basename(output_file)
 				self.gcode.run_script_from_command(f'SDCARD_PRINT_FILE FILENAME="{basename}"')
 				
+				file_progress = state_data.get('file_progress', {})
 				msg = [
 					f"Created and started power loss recovery file: {basename}",
 					f"Original file: {current_file}",
@@ -2071,191 +3657,458 @@ class PowerLossRecovery:
 		except Exception as e:
 			gcmd.respond_info(f"Error processing PLR resume: {str(e)}")
 	
+	cmd_PLR_PREPARE_RESUME_help = "Start preparing the PLR resume in the background"
+	def cmd_PLR_PREPARE_RESUME(self, gcmd):
+		state_data = self._get_saved_state()
+		if not state_data:
+			gcmd.respond_info("No valid saved state found")
+			return
+		job = self._start_resume_prep(state_data)
+		if job.is_done():
+			gcmd.respond_info("Resume preparation already finished")
+		else:
+			gcmd.respond_info("Preparing resume in the background")
 	
-	def _modify_gcode_file(self, input_file: str, file_position: int) -> Optional[str]:
-		try:
-			# Get saved state for position information
-			saved_state = self._get_saved_state()
-			if not saved_state:
-				if self.debug_mode:
-					self._debug_log("PowerLossRecovery: No saved state found for position restoration")
-				return None
-				
-			# Extract Z position from saved state
-			try:
-				saved_z = saved_state['position']['z']
-				if self.debug_mode:
-					self._debug_log(f"PowerLossRecovery: Found saved Z position: {saved_z}")
-			except KeyError as e:
-				if self.debug_mode:
-					self._debug_log(f"PowerLossRecovery: Could not find Z position in saved state: {e}")
-				return None
-			
-			# Get file paths
-			base_name, ext = os.path.splitext(input_file)
-			backup_file = f"{base_name}{ext}.plr"
-			
-			# Rename original file to backup
+	def _get_resume_source(self, state_data: Dict[str, Any]) -> Tuple[str, str, int]:
+		"""Return (input_file, current_file, file_position) of a saved state"""
+		current_file = state_data.get('current_file')
+		if not current_file:
+			raise self.printer.command_error("No filename found in saved state")
+		file_position = state_data.get('file_progress', {}).get('position')
+		if file_position is None:
+			raise self.printer.command_error("No file position found in saved state")
+		
+		# Get gcode directory from config and construct full file path
+		input_file = os.path.join(self._get_gcode_dir(), current_file)
+		if not os.path.exists(input_file):
+			raise self.printer.command_error(f"Original gcode file not found: {input_file}")
+		return input_file, current_file, file_position
+	
+	def _start_resume_prep(self, state_data: Dict[str, Any]) -> ResumePrepJob:
+		"""
+		Start building the resume artifact for the saved state, so it runs
+		concurrently with heating and homing. Reuses a running or finished
+		job for the same state and file.
+		"""
+		input_file, current_file, file_position = self._get_resume_source(state_data)
+		excluded_objects = ()
+		if self.skip_excluded_objects:
+			excluded_objects = tuple(state_data.get('excluded_objects', ()))
+		st = os.stat(input_file)
+		key = (input_file, file_position, self.resume_mode, excluded_objects,
+			   st.st_size, st.st_mtime_ns)
+		job = self._resume_prep
+		if job is not None and job.key == key:
+			return job
+		self._discard_resume_prep()
+		self._check_resume_placeholders(input_file, file_position)
+		saved_z = state_data['position']['z']
+		if self.resume_mode == 'virtual':
+			prepare_cb = lambda: self._build_virtual_prologue(input_file, file_position, saved_z,
+															  excluded_objects)
+		else:
+			prepare_cb = lambda: self._write_resume_file(input_file, file_position, saved_z,
+														 excluded_objects)
+		job = ResumePrepJob(key, prepare_cb)
+		self._resume_prep = job
+		job.start()
+		if self.debug_mode:
+			self._debug_log(f"Started resume preparation for {current_file} at {file_position}")
+		return job
+	
+	def _wait_resume_prep(self, job: ResumePrepJob):
+		"""Wait for a preparation job without blocking the reactor"""
+		eventtime = self.reactor.monotonic()
+		while not job.is_done():
+			eventtime = self.reactor.pause(eventtime + 0.050)
+	
+	def _discard_resume_prep(self):
+		"""Drop a stale preparation job and its temporary file"""
+		job = self._resume_prep
+		self._resume_prep = None
+		if job is None:
+			return
+		self._wait_resume_prep(job)
+		if isinstance(job.result, str):
 			try:
-				os.rename(input_file, backup_file)
-				if self.debug_mode:
-					self._debug_log(f"PowerLossRecovery: Renamed original file to {backup_file}")
-			except Exception as e:
-				if self.debug_mode:
-					self._debug_log(f"PowerLossRecovery: Error renaming original file: {str(e)}")
-				return None
-			
+				os.remove(job.result)
+			except OSError:
+				pass
+	
+	def _write_resume_file(self, input_file: str, file_position: int,
+						   saved_z: float, excluded_objects=()) -> Optional[str]:
+		"""
+		Write the resume file next to the original: the header up to the
+		setup placeholder, the restart G-code and the original G-code from
+		file_position onwards without the regions of excluded objects. Only
+		the header and the layer context before the resume point are parsed,
+		the remainder is bulk copied. Safe to run outside the reactor thread.
+		Returns the path of the temporary file or None on failure.
+		"""
+		temp_file = f"{input_file}.plrtmp"
+		index = self._get_layer_index(input_file)
+		try:
 			if self.debug_mode:
 				self._debug_log(f"PowerLossRecovery: Modifying {input_file} to resume from position {file_position}")
 			
-			# Define placeholder texts
-			SETUP_PLACEHOLDER = ";;;;; PLR_RESUME - INITIAL PRINTER SETUP STARTS ;;;;;"
-			GCODE_PLACEHOLDER = ";;;;; PLR_RESUME - PRINT GCODE STARTS ;;;;;"
-			
-			# Track state
-			found_setup = False
-			found_gcode_start = False
-			current_position = 0
-			last_layer_z = None
-			
-			# Buffer to track potential layer change block
-			layer_block_lines = []
-			in_layer_block = False
-			
-			with open(backup_file, 'r') as infile, open(input_file, 'w') as outfile:
-				in_setup_section = False
-				in_comment_block = False
-				in_executable_block = False
-				comment_buffer = []
-				
-				for line in infile:
-					current_position += len(line)
-					stripped_line = line.strip()
-					
-					# Check for executable block start/end
-					if "; EXECUTABLE_BLOCK_START" in line:
-						in_executable_block = True
-						outfile.write(line)
-						continue
-					elif "; EXECUTABLE_BLOCK_END" in line:
-						in_executable_block = False
-						outfile.write(line)
-						continue
-						
-					# Track layer change blocks before resume position
-					if current_position < file_position:
-						if stripped_line == ";LAYER_CHANGE":
-							in_layer_block = True
-							layer_block_lines = [line]
-						elif in_layer_block:
-							layer_block_lines.append(line)
-							if stripped_line.startswith(";Z:"):
-								try:
-									last_layer_z = float(stripped_line[3:])
-								except ValueError:
-									pass
-							elif not stripped_line.startswith(";"):
-								in_layer_block = False
-								layer_block_lines = []
-					
-					# Handle comment blocks, but not if we're in an executable block
-					if not in_executable_block:
-						if not in_comment_block and stripped_line.startswith(';') and not stripped_line.startswith(';;'):
-							in_comment_block = True
-							comment_buffer = [line]
-							continue
-						elif in_comment_block:
-							if stripped_line.startswith(';'):
-								comment_buffer.append(line)
-								continue
-							else:
-								in_comment_block = False
-								for comment_line in comment_buffer:
-									outfile.write(comment_line)
-								comment_buffer = []
-					
-					# Process placeholders if we're not in a comment block or we're in an executable block
-					if not in_comment_block or in_executable_block:
-						if SETUP_PLACEHOLDER in line:
-							found_setup = True
-							in_setup_section = True
-							# Write setup placeholder
-							outfile.write(line)
-							
-							# Write restart gcode
-							if self.restart_gcode_lines:
-								if self.debug_mode:
-									self._debug_log(f"Writing {len(self.restart_gcode_lines)} restart G-code lines")
-								for gcode_line in self.restart_gcode_lines:
-									if self.debug_mode:
-										self._debug_log(f"Writing line: {repr(gcode_line)}")
-									outfile.write(f"{gcode_line}\n")
-								
-								# Add Z restoration based on last layer height
-								z_height = last_layer_z if last_layer_z is not None else saved_z
-								z_restore_gcode = f"G1 Z{z_height:.3f} F3000 ; Restore Z height from last layer"
-								if self.debug_mode:
-									self._debug_log(f"Writing Z restore: {z_restore_gcode}")
-									if last_layer_z is not None:
-										self._debug_log(f"Using last layer Z height: {last_layer_z}")
-									else:
-										self._debug_log(f"Using saved Z position: {saved_z}")
-								outfile.write(f"{z_restore_gcode}\n")
-							
-							# Write gcode placeholder immediately after
-							outfile.write(f"{GCODE_PLACEHOLDER}\n")
-							found_gcode_start = True
-							in_setup_section = False
-							continue
-						elif GCODE_PLACEHOLDER in line:
-							# Skip the original GCODE_PLACEHOLDER since we already wrote it
-							continue
-					
-					# Handle non-setup sections and other lines
-					if not found_setup:
-						outfile.write(line)
-					elif found_gcode_start:
-						if current_position >= file_position:
-							outfile.write(line)
-					elif in_executable_block:
-						# Write lines in executable blocks before setup
-						outfile.write(line)
-					elif in_comment_block and not in_setup_section:
-						# Write comment lines as-is if not in setup section
-						outfile.write(line)
-					
-				# Write any remaining comment buffer at EOF
-				if comment_buffer:
-					for line in comment_buffer:
-						outfile.write(line)
-			
-			if not (found_setup and found_gcode_start):
-				if self.debug_mode:
-					self._debug_log("PowerLossRecovery: Required placeholders not found in gcode file")
-				# Restore original file if modification failed
-				os.remove(input_file)
-				os.rename(backup_file, input_file)
-				return None
+			with open(input_file, 'rb') as infile, open(temp_file, 'wb', buffering=0) as outfile:
+				data = map_file(infile)
+				try:
+					layout = self._scan_resume_layout(data, file_position, index)
+					if layout is None:
+						raise ValueError("Required placeholders not found in gcode file")
+					setup_end, resume_offset, last_layer_z, modal_state = layout
+					header_segments = [(0, setup_end)]
+					if self.resume_header_metadata == 'drop':
+						header_segments = skip_ranges(0, setup_end,
+													  find_metadata_blocks(data, 0, setup_end))
+					skipped = []
+					if excluded_objects:
+						skipped = self._excluded_object_ranges(data, resume_offset, index,
+															   excluded_objects, modal_state)
+				finally:
+					if isinstance(data, mmap.mmap):
+						data.close()
 				
-			if self.debug_mode:
-				self._debug_log(f"PowerLossRecovery: Successfully created modified file: {input_file}")
-				self._debug_log(f"PowerLossRecovery: Original file backed up as: {backup_file}")
-			
-			return input_file
+				# Header including the setup placeholder, copied as opaque ranges
+				for start, end in header_segments:
+					copy_file_range(infile, outfile, start, end - start)
+				
+				# Restart gcode
+				restart = self._build_restart_lines(last_layer_z, saved_z, modal_state,
+													excluded_objects)
+				restart.append(PLR_GCODE_PLACEHOLDER.decode())
+				write_all(outfile, ("\n".join(restart) + "\n").encode())
+				
+				# Everything from the resume point onwards, without excluded objects
+				file_size = os.fstat(infile.fileno()).st_size
+				pos = resume_offset
+				for start, end, e_position in skipped:
+					copy_file_range(infile, outfile, pos, start - pos)
+					pos = end
+					if e_position is not None:
+						write_all(outfile, f"G92 E{e_position:.5f}\n".encode())
+				copy_file_range(infile, outfile, pos, file_size - pos)
+				if self.debug_mode and skipped:
+					self._debug_log(f"Skipped {len(skipped)} regions of excluded objects "
+									f"({sum(e - s for s, e, _ in skipped)} bytes)")
+			return temp_file
 			
 		except Exception as e:
 			if self.debug_mode:
 				self._debug_log(f"PowerLossRecovery: Error modifying gcode file: {str(e)}")
-			# Attempt to restore original file if an error occurred
 			try:
-				if os.path.exists(input_file):
-					os.remove(input_file)
-				if os.path.exists(backup_file):
-					os.rename(backup_file, input_file)
-			except:
+				os.remove(temp_file)
+			except OSError:
 				pass
 			return None
 	
+	def _install_resume_file(self, input_file: str, temp_file: str) -> Optional[str]:
+		"""Back up the original file as .plr and move the resume file in its place"""
+		backup_file = f"{input_file}.plr"
+		try:
+			os.rename(input_file, backup_file)
+			if self.debug_mode:
+				self._debug_log(f"PowerLossRecovery: Renamed original file to {backup_file}")
+		except Exception as e:
+			if self.debug_mode:
+				self._debug_log(f"PowerLossRecovery: Error renaming original file: {str(e)}")
+			os.remove(temp_file)
+			return None
+		try:
+			os.rename(temp_file, input_file)
+		except Exception as e:
+			if self.debug_mode:
+				self._debug_log(f"PowerLossRecovery: Error installing modified file: {str(e)}")
+			os.rename(backup_file, input_file)
+			return None
+		if self.debug_mode:
+			self._debug_log(f"PowerLossRecovery: Successfully created modified file: {input_file}")
+			self._debug_log(f"PowerLossRecovery: Original file backed up as: {backup_file}")
+		return input_file
+	
+	def _scan_resume_layout(self, data, file_position: int,
+							index: Optional[GCodeLayerIndex] = None
+							) -> Optional[Tuple[int, int, Optional[float], Optional[GCodeModalState]]]:
+		"""
+		Locate the resume placeholders in the memory mapped G-code file,
+		using the layer index when available. All offsets are byte offsets,
+		matching the virtual_sdcard file_position.
+		Returns (setup_end, resume_offset, last_layer_z, modal_state) or None
+		if the file cannot be resumed.
+		"""
+		setup_end, gcode_start_end = self._find_placeholders(data, file_position, index)
+		if setup_end is None or setup_end > file_position:
+			return None
+		
+		# Resume at the start of the line containing file_position
+		resume_offset = data.rfind(b'\n', 0, file_position) + 1
+		if index is not None and self.resume_at_layer_start:
+			i = index.find(resume_offset)
+			if i is not None:
+				resume_offset = index.offsets[i]
+				if self.debug_mode:
+					self._debug_log(f"Resuming at start of layer {index.layers[i]} (offset {resume_offset})")
+		if gcode_start_end is not None:
+			resume_offset = max(resume_offset, gcode_start_end)
+		if index is not None:
+			last_layer_z = index.last_z_before(resume_offset)
+		else:
+			last_layer_z = self._find_last_layer_z(data, setup_end, resume_offset)
+		modal_state = None
+		if self.restore_modal_state:
+			modal_state = self._reconstruct_modal_state(data, index, resume_offset)
+		return setup_end, resume_offset, last_layer_z, modal_state
+	
+	def _find_placeholders(self, data, file_position: int,
+						   index: Optional[GCodeLayerIndex] = None
+						   ) -> Tuple[Optional[int], Optional[int]]:
+		"""
+		Placeholder offsets from the layer index, or from a scan of the
+		header limited to placeholder_scan_bytes.
+		"""
+		if index is not None:
+			return index.setup_end, index.gcode_start_end
+		scan_end = file_position
+		if self.placeholder_scan_bytes:
+			scan_end = min(scan_end, self.placeholder_scan_bytes)
+		return find_placeholders(data, 0, scan_end)
+	
+	def _check_resume_placeholders(self, input_file: str, file_position: int):
+		"""Fail early if the file cannot be resumed at file_position"""
+		index = self._get_layer_index(input_file)
+		with open(input_file, 'rb') as infile:
+			data = map_file(infile)
+			try:
+				setup_end, _ = self._find_placeholders(data, file_position, index)
+			finally:
+				if isinstance(data, mmap.mmap):
+					data.close()
+		if setup_end is None or setup_end > file_position:
+			raise self.printer.command_error(
+				"Required PLR_RESUME placeholders not found in gcode file")
+	
+	def _reconstruct_modal_state(self, data, index: Optional[GCodeLayerIndex],
+								 resume_offset: int) -> GCodeModalState:
+		"""
+		Replay the modal commands before resume_offset. With a layer index
+		only the current layer is parsed, starting from the state stored
+		for it.
+		"""
+		start = 0
+		state = GCodeModalState()
+		if index is not None:
+			i = index.find(resume_offset)
+			if i is not None:
+				start = index.offsets[i]
+				state = GCodeModalState.from_snapshot(index.states[i])
+		state.replay(data, start, resume_offset)
+		state.find_motion_state(data, 0, resume_offset)
+		if self.debug_mode:
+			self._debug_log(f"Reconstructed modal state from offset {start}: {state.to_dict()}")
+		return state
+	
+	def _excluded_object_ranges(self, data, resume_offset: int,
+								index: Optional[GCodeLayerIndex], excluded_objects,
+								modal_state: Optional[GCodeModalState]) -> list:
+		"""
+		Byte ranges after resume_offset belonging to excluded objects, as
+		(start, end, e_position) tuples. e_position is the absolute E at the
+		end of the range, which has to be restored with G92 in absolute
+		extrusion mode.
+		"""
+		if index is not None:
+			objects = index.objects
+		else:
+			# Include an object that is open at the resume point
+			scan_start = data.rfind(b'\nEXCLUDE_OBJECT_START', 0, resume_offset) + 1
+			objects = ObjectRanges.scan(data, scan_start, len(data))
+		if modal_state is None:
+			modal_state = self._reconstruct_modal_state(data, index, resume_offset)
+		elif (modal_state.current_object is not None
+				and modal_state.current_object.upper() in {n.upper() for n in excluded_objects}):
+			# The EXCLUDE_OBJECT_END of this object is skipped as well
+			modal_state.current_object = None
+		skipped = []
+		pos = resume_offset
+		for start, end in objects.select(excluded_objects, resume_offset):
+			start = max(start, pos)
+			if end <= start:
+				continue
+			e_position = None
+			if modal_state.absolute_extrude:
+				e_position = GCodeModalState.last_e_position(data, start, end)
+			skipped.append((start, end, e_position))
+			pos = end
+		return skipped
+	
+	def _build_restart_lines(self, last_layer_z: Optional[float], saved_z: float,
+							 modal_state: Optional[GCodeModalState] = None,
+							 excluded_objects=()) -> list:
+		"""
+		Restart G-code, the Z restore move, the excluded objects and the
+		modal state preamble
+		"""
+		restart = []
+		if self.restart_gcode_lines:
+			if self.debug_mode:
+				self._debug_log(f"Writing {len(self.restart_gcode_lines)} restart G-code lines")
+			restart.extend(self.restart_gcode_lines)
+			
+			# Add Z restoration based on last layer height
+			z_height = last_layer_z if last_layer_z is not None else saved_z
+			restart.append(f"G1 Z{z_height:.3f} F3000 ; Restore Z height from last layer")
+			if self.debug_mode:
+				self._debug_log(f"Writing Z restore: {restart[-1]}")
+				if last_layer_z is not None:
+					self._debug_log(f"Using last layer Z height: {last_layer_z}")
+				else:
+					self._debug_log(f"Using saved Z position: {saved_z}")
+		for name in excluded_objects:
+			restart.append(f"EXCLUDE_OBJECT NAME={name}")
+		if modal_state is not None:
+			restart.extend(modal_state.restore_gcode())
+		return restart
+	
+	def _get_layer_index(self, gcode_path: str) -> Optional[GCodeLayerIndex]:
+		if not self.build_layer_index:
+			return None
+		index = GCodeLayerIndex.load_for(gcode_path)
+		if index is None and self.debug_mode:
+			self._debug_log(f"No valid layer index for {gcode_path}, scanning file")
+		return index
+	
+	def _start_index_build(self, gcode_path: str) -> bool:
+		"""Build the layer index sidecar in a background thread"""
+		thread = self._index_builds.get(gcode_path)
+		if thread is not None and thread.is_alive():
+			return False
+		if GCodeLayerIndex.load_for(gcode_path) is not None:
+			return False
+		thread = threading.Thread(target=self._build_index_worker, args=(gcode_path,),
+								  name="plr-layer-index")
+		thread.daemon = True
+		self._index_builds[gcode_path] = thread
+		thread.start()
+		return True
+	
+	def _build_index_worker(self, gcode_path: str):
+		# Runs outside the reactor - only use thread safe logging here
+		try:
+			start = time.monotonic()
+			index = GCodeLayerIndex.build(gcode_path)
+			index.save(GCodeLayerIndex.sidecar_path(gcode_path))
+			logging.info(f"PowerLossRecovery: Built layer index for {gcode_path} "
+						 f"({len(index.offsets)} layers in {time.monotonic() - start:.1f}s)")
+			if index.setup_end is None:
+				logging.warning(f"PowerLossRecovery: {gcode_path} has no PLR_RESUME "
+								"placeholders and cannot be resumed")
+		except Exception:
+			logging.exception(f"PowerLossRecovery: Error building layer index for {gcode_path}")
+	
+	def _handle_load_file(self):
+		if not self.build_layer_index:
+			return
+		try:
+			virtual_sdcard = self.printer.lookup_object('virtual_sdcard')
+			gcode_path = virtual_sdcard.file_path()
+			if gcode_path and os.path.isfile(gcode_path):
+				self._start_index_build(gcode_path)
+		except Exception as e:
+			if self.debug_mode:
+				logging.info(f"PowerLossRecovery: Error starting layer index build: {str(e)}")
+	
+	cmd_PLR_BUILD_INDEX_help = "Build the PLR layer index for a G-code file (e.g. after upload)"
+	def cmd_PLR_BUILD_INDEX(self, gcmd):
+		filename = gcmd.get('FILENAME')
+		gcode_path = os.path.join(self._get_gcode_dir(), filename.lstrip('/'))
+		if not os.path.isfile(gcode_path):
+			raise gcmd.error(f"File not found: {filename}")
+		if self._start_index_build(gcode_path):
+			gcmd.respond_info(f"Building layer index for {filename}")
+		else:
+			gcmd.respond_info(f"Layer index for {filename} is up to date or already being built")
+	
+	def _build_virtual_prologue(self, input_file: str, file_position: int,
+								saved_z: float, excluded_objects=()) -> Optional[Tuple[list, int]]:
+		"""
+		Build the G-code run before continuing the original file: the
+		header's commands and the restart G-code. The original file cannot
+		be elided, excluded objects are re-excluded so exclude_object skips
+		them. Safe to run outside the reactor thread.
+		Returns (prologue_lines, resume_offset) or None if the file cannot be
+		resumed.
+		"""
+		index = self._get_layer_index(input_file)
+		with open(input_file, 'rb') as infile:
+			data = map_file(infile)
+			try:
+				layout = self._scan_resume_layout(data, file_position, index)
+				if layout is None:
+					return None
+				setup_end, resume_offset, last_layer_z, modal_state = layout
+				# Thumbnails and config dumps are comments, skip them unparsed
+				prologue = []
+				for start, end in skip_ranges(0, setup_end,
+											  find_metadata_blocks(data, 0, setup_end)):
+					for line in data[start:end].split(b'\n'):
+						line = line.split(b';', 1)[0].strip()
+						if line:
+							prologue.append(line.decode('utf-8', errors='replace'))
+			finally:
+				if isinstance(data, mmap.mmap):
+					data.close()
+		
+		prologue.extend(self._build_restart_lines(last_layer_z, saved_z, modal_state,
+												  excluded_objects))
+		return prologue, resume_offset
+	
+	def _start_virtual_resume(self, gcmd, state_data, current_file: str, file_position: int,
+							  prepared: Tuple[list, int]):
+		"""
+		Resume without creating a new file: run the prepared prologue
+		directly, then let virtual_sdcard continue the original file at the
+		resume offset.
+		"""
+		prologue, resume_offset = prepared
+		if self.debug_mode:
+			self._debug_log(f"Virtual resume of {current_file} at offset {resume_offset} "
+							f"with {len(prologue)} prologue lines")
+		
+		# Loading the file resets print_stats, so select it before the prologue
+		# Excluded objects are re-issued by the prologue and skipped by exclude_object
+		self.gcode.run_script_from_command(f"M23 {current_file}")
+		self.gcode.run_script_from_command("\n".join(prologue))
+		self.gcode.run_script_from_command(f"M26 S{resume_offset}\nM24")
+		
+		file_progress = state_data.get('file_progress', {})
+		gcmd.respond_info("\n".join([
+			f"Resumed {current_file} at offset {resume_offset} without creating a copy",
+			f"Resume position: {file_position} ({file_progress.get('progress_pct', 0):.1f}%)"
+		]))
+	
+	def _find_last_layer_z(self, data, start: int, end: int) -> Optional[float]:
+		"""
+		Find the last ;LAYER_CHANGE block before end and return the value of
+		its ;Z: comment.
+		"""
+		idx = data.rfind(b';LAYER_CHANGE', start, end)
+		if idx < 0:
+			return None
+		pos = line_end(data, idx)
+		while pos < end:
+			next_pos = line_end(data, pos)
+			line = data[pos:next_pos].strip()
+			if line.startswith(b';Z:'):
+				try:
+					return float(line[3:])
+				except ValueError:
+					return None
+			if not line.startswith(b';'):
+				break
+			pos = next_pos
+		return None
+	
 	def _restore_original_gcode(self, filename: str):
 		"""Restore the original gcode file after print completion or cancellation"""
 		try:
@@ -0,0 +1,123 @@
+# Stub Klipper objects for the klipper extension tests
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import os
+import sys
+import time
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import power_loss_recovery
+
+class ConfigError(Exception):
+	pass
+
+class CommandError(Exception):
+	pass
+
+class StubReactor:
+	NOW = 0.
+
+	def monotonic(self):
+		return time.monotonic()
+
+	def pause(self, waketime):
+		return time.monotonic()
+
+	def register_timer(self, callback, waketime=None):
+		return callback
+
+class StubGCode:
+	def __init__(self):
+		self.commands = {}
+		self.scripts = []
+		self.messages = []
+
+	def register_command(self, cmd, func, desc=None):
+		self.commands[cmd] = func
+
+	def run_script_from_command(self, script):
+		self.scripts.append(script)
+
+	def respond_info(self, msg):
+		self.messages.append(msg)
+
+class StubSaveVariables:
+	def __init__(self, filename):
+		self.filename = filename
+		self.allVariables = {}
+
+	def get_status(self, eventtime):
+		return {'variables': self.allVariables}
+
+class StubPrinter:
+	config_error = ConfigError
+	command_error = CommandError
+
+	def __init__(self, variables_file):
+		self.reactor = StubReactor()
+		self.objects = {
+			'gcode': StubGCode(),
+			'save_variables': StubSaveVariables(variables_file),
+		}
+		self.event_handlers = {}
+
+	def get_reactor(self):
+		return self.reactor
+
+	def lookup_object(self, name, default=None):
+		return self.objects.get(name, default)
+
+	def load_object(self, config, name):
+		return self.objects[name]
+
+	def register_event_handler(self, event, callback):
+		self.event_handlers.setdefault(event, []).append(callback)
+
+class StubConfig:
+	"""Config section returning the option defaults, with overrides"""
+	_missing = object()
+
+	def __init__(self, printer, name, options=None):
+		self.printer = printer
+		self.name = name
+		self.options = options or {}
+		self.error = ConfigError
+
+	def get_printer(self):
+		return self.printer
+
+	def get_name(self):
+		return self.name
+
+	def get(self, option, default=_missing, **kwargs):
+		if option in self.options:
+			return self.options[option]
+		if default is self._missing:
+			raise ConfigError(f"Option '{option}' in section '{self.name}' must be specified")
+		return default
+
+	def getint(self, option, default=_missing, **kwargs):
+		return int(self.get(option, default))
+
+	def getfloat(self, option, default=_missing, **kwargs):
+		return float(self.get(option, default))
+
+	def getboolean(self, option, default=_missing, **kwargs):
+		return bool(self.get(option, default))
+
+	def getchoice(self, option, choices, default=_missing, **kwargs):
+		return choices[self.get(option, default)]
+
+@pytest.fixture
+def printer(tmp_path):
+	return StubPrinter(str(tmp_path / 'variables.cfg'))
+
+@pytest.fixture
+def plr(printer):
+	config = StubConfig(printer, 'power_loss_recovery')
+	return power_loss_recovery.PowerLossRecovery(config)
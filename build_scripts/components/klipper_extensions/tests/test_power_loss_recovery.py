@@ -0,0 +1,151 @@
+# Tests for the power loss recovery klipper extension
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import os
+
+import pytest
+
+import power_loss_recovery
+
+def replay(gcode):
+	state = power_loss_recovery.GCodeModalState()
+	state.replay(gcode, 0, len(gcode))
+	return state
+
+def test_modal_state_part_fan():
+	state = replay(b"M106 S127\nG1 X1\nM106 P0 S200\n")
+	assert state.fan == 200.
+	assert replay(b"M106 S127\nM107\n").fan == 0.
+	assert replay(b"M106\n").fan == 255.
+
+def test_modal_state_ignores_indexed_fans():
+	# Orca/Flashforge profiles drive the chamber/aux fan with M106 P2
+	state = replay(b"M106 S102\nM106 P2 S255\nM106 P3 S50\n")
+	assert state.fan == 102.
+	state = replay(b"M106 S102\nM107 P2\n")
+	assert state.fan == 102.
+	assert "M106 S102" in state.restore_gcode()
+
+class FakeStepper:
+	def __init__(self, name):
+		self.name = name
+		self.trapq = None
+
+	def get_name(self):
+		return self.name
+
+	def set_trapq(self, trapq):
+		self.trapq = trapq
+
+class FakeToolhead:
+	def __init__(self, steppers):
+		self.steppers = steppers
+		self.position = [0., 0., 10., 0.]
+		self.moves = []
+
+	def get_status(self, eventtime):
+		return {'homed_axes': 'xyz'}
+
+	def get_position(self):
+		return list(self.position)
+
+	def manual_move(self, pos, speed):
+		moved = [s.get_name() for s in self.steppers if s.trapq is not None]
+		self.moves.append((moved, pos[2] - self.position[2]))
+		self.position = list(pos)
+
+	def get_trapq(self):
+		return 'trapq'
+
+	def flush_step_generation(self):
+		pass
+
+	def wait_moves(self):
+		pass
+
+class FakeGCodeCommand:
+	def __init__(self, params):
+		self.params = params
+		self.messages = []
+
+	def get(self, name, default=None):
+		return self.params.get(name, default)
+
+	def respond_info(self, msg):
+		self.messages.append(msg)
+
+def setup_z_home(printer, plr, probed_offsets):
+	steppers = [FakeStepper(name) for name in ('stepper_z', 'stepper_z1', 'stepper_z2')]
+	toolhead = FakeToolhead(steppers)
+	printer.objects['toolhead'] = toolhead
+	plr.z_steppers = steppers
+	plr.stepper_names = [s.get_name() for s in steppers]
+	plr.endstops = ['endstop_z', 'endstop_z1', 'endstop_z2']
+
+	def probing_move(endstops, pos, speed):
+		toolhead.position[2] = 8.
+		return list(toolhead.position), {}
+	def probe_z_steppers(toolhead, mode, reference_z):
+		plr.z_offsets.update(probed_offsets)
+	plr._endstops_probing_move = probing_move
+	plr._probe_z_steppers = probe_z_steppers
+	return toolhead
+
+def offset_moves(toolhead):
+	"""Z moves made with a single stepper enabled"""
+	return {moved[0]: dz for moved, dz in toolhead.moves if len(moved) == 1}
+
+def test_z_home_resume_applies_saved_offsets_after_probing(printer, plr):
+	# Probed offsets include the tilt of the gantry after the outage
+	toolhead = setup_z_home(printer, plr, {'stepper_z1': 0.12, 'stepper_z2': 0.05})
+	# Saved offset without endstop position, the cache can't be used
+	printer.objects['save_variables'].allVariables['z_offset_stepper_z1'] = 0.3
+
+	gcmd = FakeGCodeCommand({'MODE': 'RESUME'})
+	plr.cmd_PLR_Z_HOME(gcmd)
+	assert any("Full Z probing required" in msg for msg in gcmd.messages)
+	# stepper_z2 was never calibrated and falls back to the probed offset
+	assert offset_moves(toolhead) == {'stepper_z1': pytest.approx(0.3),
+									  'stepper_z2': pytest.approx(0.05)}
+
+def test_z_home_resume_fast_path_keeps_alignment(printer, plr):
+	toolhead = setup_z_home(printer, plr, {})
+	variables = printer.objects['save_variables'].allVariables
+	variables['z_offset_stepper_z1'] = 0.3
+	variables['z_offset_stepper_z2'] = -0.1
+	variables['z_endstop_position_stepper_z'] = [0., 0., 8.]
+	plr._check_cached_calibration = lambda travel: (
+		{'stepper_z1': 0.3, 'stepper_z2': -0.1}, None)
+
+	plr.cmd_PLR_Z_HOME(FakeGCodeCommand({'MODE': 'RESUME'}))
+	assert offset_moves(toolhead) == {}
+	expected_z = 8. + plr.z_height_offset
+	assert f"SET_KINEMATIC_POSITION Z={expected_z}" in printer.objects['gcode'].scripts
+
+def test_calibration_stable_updated_on_record(plr):
+	plr.z_offsets = {'stepper_z1': 0.3}
+	for _ in range(plr.calibration_stable_runs):
+		assert plr.calibration_stable is None
+		plr._record_calibration([0., 0., 8.])
+	assert plr.calibration_stable is True
+	plr.z_offsets = {'stepper_z1': 0.5}
+	plr._record_calibration([0., 0., 8.])
+	assert plr.calibration_stable is False
+
+def write_with_state_writer(plr, filename):
+	writer = power_loss_recovery.StateWriter(filename, plr._snapshot_variables, plr.save_stats)
+	writer.start()
+	writer.submit()
+	writer.stop()
+	return writer.get_stats()
+
+def test_lifetime_bytes_count_completed_writes(plr, tmp_path):
+	plr.save_stats.set_lifetime_bytes(1000)
+	stats = write_with_state_writer(plr, str(tmp_path / 'missing' / 'variables.cfg'))
+	assert stats['error_count'] == 1
+	assert plr.save_stats.get_lifetime_bytes() == 1000
+
+	filename = str(tmp_path / 'variables.cfg')
+	write_with_state_writer(plr, filename)
+	assert plr.save_stats.get_lifetime_bytes() == 1000 + os.path.getsize(filename)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# Benchmark for the power loss recovery resume path and md5 check
+#
+# Runs the klipper extensions against stub printer objects on synthetic
+# G-code files, so regressions in resume generation, hashing and state
+# saving show up on a development machine before flashing an image.
+#
+# Usage: plr_benchmark.py [--size-mb 50] [--layers 500] [--styles prusa,orca,cura]
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import power_loss_recovery
+import md5_checker
+
+STYLES = ('prusa', 'orca', 'cura')
+
+######################################################################
+# Stub Klipper objects
+######################################################################
+
+class ConfigError(Exception):
+	pass
+
+class CommandError(Exception):
+	pass
+
+class StubReactor:
+	def monotonic(self):
+		return time.monotonic()
+
+	def pause(self, waketime):
+		time.sleep(max(0., waketime - time.monotonic()))
+		return time.monotonic()
+
+	def register_timer(self, callback, waketime=None):
+		return callback
+
+class StubGCode:
+	def __init__(self):
+		self.commands = {}
+		self.scripts = []
+		self.messages = []
+
+	def register_command(self, cmd, func, desc=None):
+		self.commands[cmd] = func
+
+	def run_script_from_command(self, script):
+		self.scripts.append(script)
+
+	def respond_info(self, msg):
+		self.messages.append(msg)
+
+	def _respond_error(self, msg):
+		self.messages.append(msg)
+
+class StubSaveVariables:
+	def __init__(self, filename):
+		self.filename = filename
+		self.allVariables = {}
+
+	def get_status(self, eventtime):
+		return {'variables': self.allVariables}
+
+class StubVirtualSDCard:
+	def __init__(self, sdcard_dirname):
+		self.sdcard_dirname = sdcard_dirname
+		self.current_file = None
+		self.cancelled = False
+
+	def file_path(self):
+		return self.current_file
+
+	def do_cancel(self):
+		self.cancelled = True
+
+class StubPrinter:
+	config_error = ConfigError
+	command_error = CommandError
+
+	def __init__(self, gcode_dir, variables_file):
+		self.reactor = StubReactor()
+		self.objects = {
+			'gcode': StubGCode(),
+			'virtual_sdcard': StubVirtualSDCard(gcode_dir),
+			'save_variables': StubSaveVariables(variables_file),
+		}
+		self.event_handlers = {}
+
+	def get_reactor(self):
+		return self.reactor
+
+	def lookup_object(self, name, default=None):
+		return self.objects.get(name, default)
+
+	def load_object(self, config, name):
+		return self.objects[name]
+
+	def register_event_handler(self, event, callback):
+		self.event_handlers.setdefault(event, []).append(callback)
+
+	def send_event(self, event, *params):
+		for callback in self.event_handlers.get(event, []):
+			callback(*params)
+
+class StubConfig:
+	"""Config section returning the option defaults, with overrides"""
+	_missing = object()
+
+	def __init__(self, printer, name, options=None):
+		self.printer = printer
+		self.name = name
+		self.options = options or {}
+		self.error = ConfigError
+
+	def get_printer(self):
+		return self.printer
+
+	def get_name(self):
+		return self.name
+
+	def get(self, option, default=_missing, **kwargs):
+		if option in self.options:
+			return self.options[option]
+		if default is self._missing:
+			raise ConfigError(f"Option '{option}' in section '{self.name}' must be specified")
+		return default
+
+	def getint(self, option, default=_missing, **kwargs):
+		return int(self.get(option, default))
+
+	def getfloat(self, option, default=_missing, **kwargs):
+		return float(self.get(option, default))
+
+	def getboolean(self, option, default=_missing, **kwargs):
+		return bool(self.get(option, default))
+
+	def getchoice(self, option, choices, default=_missing, **kwargs):
+		return choices[self.get(option, default)]
+
+######################################################################
+# Synthetic G-code
+######################################################################
+
+def thumbnail_lines(width, height, size):
+	data = base64.b64encode(random.randbytes(size * 3 // 4)).decode()
+	lines = [f"; thumbnail begin {width}x{height} {len(data)}"]
+	lines += [f"; {data[i:i + 78]}" for i in range(0, len(data), 78)]
+	lines.append("; thumbnail end")
+	return lines
+
+def config_lines(count):
+	return [f"; option_{i} = {random.random():.6f}" for i in range(count)]
+
+def header_lines(style, thumbnail_kb):
+	setup = [
+		"M140 S60",
+		"M104 S215",
+		power_loss_recovery.PLR_SETUP_PLACEHOLDER.decode(),
+		"G28",
+		"M190 S60",
+		"M109 S215",
+		"G1 Z5 F3000",
+		power_loss_recovery.PLR_GCODE_PLACEHOLDER.decode(),
+		"G90",
+		"M83",
+	]
+	thumb = thumbnail_lines(300, 300, thumbnail_kb * 1024)
+	if style == 'prusa':
+		return (["; generated by PrusaSlicer 2.8.0", ""] + thumbnail_lines(16, 16, 512)
+				+ thumb + ["", "; external perimeters extrusion width = 0.45mm"] + setup)
+	if style == 'orca':
+		return (["; HEADER_BLOCK_START", "; generated by OrcaSlicer 2.1.1",
+				 "; total layer number: 0", "; HEADER_BLOCK_END", "",
+				 "; THUMBNAIL_BLOCK_START"] + thumb + ["; THUMBNAIL_BLOCK_END", "",
+				 "; CONFIG_BLOCK_START"] + config_lines(400) + ["; CONFIG_BLOCK_END", ""]
+				+ setup)
+	return [";FLAVOR:Marlin", ";TIME:6666", ";Generated with Cura_SteamEngine 5.7.1",
+			";START_OF_HEADER", ";END_OF_HEADER"] + thumb + setup
+
+def layer_lines(style, layer, z, moves, e_per_move):
+	if style == 'cura':
+		lines = [f";LAYER:{layer}", f"G0 F9000 Z{z:.2f}"]
+	else:
+		lines = [";LAYER_CHANGE", f";Z:{z:.2f}", ";HEIGHT:0.2", f"G1 Z{z:.2f} F720"]
+	if layer == 1:
+		lines += ["M106 S255", "M104 S210"]
+	lines.append("EXCLUDE_OBJECT_START NAME=part_1")
+	for i in range(moves):
+		x = 100. + 50. * ((i * 37) % 101) / 101.
+		y = 100. + 50. * ((i * 53) % 103) / 103.
+		lines.append(f"G1 X{x:.3f} Y{y:.3f} E{e_per_move:.5f} F1800")
+	lines += ["EXCLUDE_OBJECT_END NAME=part_1", "G1 E-0.8 F2100"]
+	return lines
+
+def footer_lines(style):
+	if style == 'prusa':
+		return (["M107", "M104 S0", "M140 S0", "; prusaslicer_config = begin"]
+				+ config_lines(600) + ["; prusaslicer_config = end"])
+	if style == 'cura':
+		return ["M107", "M104 S0", "M140 S0", ";End of Gcode"] + [
+			f";SETTING_3 {json.dumps({'n': i})}" for i in range(50)]
+	return ["M107", "M104 S0", "M140 S0"]
+
+def generate_gcode(path, style, size_mb, layers, thumbnail_kb=64, md5_prefix=" MD5:"):
+	"""Write a synthetic G-code file of roughly size_mb with an md5 header line"""
+	header = "\n".join(header_lines(style, thumbnail_kb)) + "\n"
+	body_bytes = max(0, size_mb * 1024 * 1024 - len(header))
+	move_bytes = len("G1 X123.456 Y123.456 E0.01234 F1800\n")
+	moves = max(1, body_bytes // max(1, layers) // move_bytes)
+	md5 = hashlib.md5()
+	tmp_path = f"{path}.body"
+	with open(tmp_path, 'wb') as f:
+		def write(text):
+			data = text.encode()
+			md5.update(data)
+			f.write(data)
+		write(header)
+		for layer in range(layers):
+			z = 0.2 * (layer + 1)
+			write("\n".join(layer_lines(style, layer, z, moves, 0.01234)) + "\n")
+		write("\n".join(footer_lines(style)) + "\n")
+	# md5_checker expects the hash of the rest of the file on the first line
+	with open(path, 'wb') as out, open(tmp_path, 'rb') as body:
+		out.write(f";{md5_prefix}{md5.hexdigest()}\n".encode())
+		shutil.copyfileobj(body, out, 1024 * 1024)
+	os.remove(tmp_path)
+	return path
+
+######################################################################
+# Benchmarks
+######################################################################
+
+def timed(func, repeat):
+	"""Returns the best duration, the last result and the peak allocation (MB)"""
+	best = None
+	result = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = func()
+		duration = time.perf_counter() - start
+		best = duration if best is None else min(best, duration)
+	# Measure memory in an extra untimed run, tracing slows allocations down.
+	# Tracing starts empty, so the peak only covers this benchmark.
+	tracemalloc.start()
+	try:
+		func()
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return best, result, peak / (1024 * 1024)
+
+def make_plr(printer, options):
+	config = StubConfig(printer, 'power_loss_recovery', options)
+	return power_loss_recovery.PowerLossRecovery(config)
+
+def synthetic_state(filename, file_position, file_size):
+	return {
+		'position': {'x': 120.5, 'y': 110.25, 'z': 12.4, 'e': 0.},
+		'layer': 62,
+		'layer_height': 0.2,
+		'current_file': filename,
+		'file_progress': {
+			'position': file_position,
+			'total_size': file_size,
+			'progress_pct': 100. * file_position / file_size,
+		},
+		'collection_time': 1234.5,
+		'save_time': time.time(),
+		'print_time': 2345.6,
+		'hotend_temp': 210.,
+		'bed_temp': 60.,
+		'fan_speeds': {'fan': 1.},
+		'position_source': 'mcu',
+	}
+
+def run_benchmarks(workdir, style, size_mb, layers, repeat):
+	gcode_dir = os.path.join(workdir, 'gcodes')
+	os.makedirs(gcode_dir, exist_ok=True)
+	filename = f"bench_{style}.gcode"
+	path = os.path.join(gcode_dir, filename)
+	variables_file = os.path.join(workdir, 'variables.cfg')
+	results = []
+
+	def report(name, measurement, nbytes=None):
+		# Throughput only for benchmarks that process nbytes, resume
+		# preparation reads a varying part of the file and only has a latency
+		duration, _, peak = measurement
+		rate = None
+		if nbytes is not None:
+			rate = nbytes / duration / (1024 * 1024) if duration > 0 else float('inf')
+		results.append((style, name, duration, rate, peak))
+
+	measurement = timed(lambda: generate_gcode(path, style, size_mb, layers), 1)
+	file_size = os.path.getsize(path)
+	report('generate', measurement, file_size)
+
+	printer = StubPrinter(gcode_dir, variables_file)
+	printer.objects['virtual_sdcard'].current_file = path
+	md5 = md5_checker.Md5Check(StubConfig(printer, 'md5_check'))
+	def md5_check():
+		md5.checked = False
+		md5.on_load_file()
+		if printer.objects['virtual_sdcard'].cancelled:
+			raise RuntimeError("md5 mismatch on synthetic file")
+	report('md5_check', timed(md5_check, repeat), file_size)
+
+	measurement = timed(lambda: power_loss_recovery.GCodeLayerIndex.build(path), repeat)
+	index = measurement[1]
+	report('index_build', measurement, file_size)
+
+	file_position = file_size * 2 // 3
+	state = synthetic_state(filename, file_position, file_size)
+	for mode in ('virtual', 'copy'):
+		for use_index in (False, True):
+			sidecar = power_loss_recovery.GCodeLayerIndex.sidecar_path(path)
+			if use_index:
+				index.save(sidecar)
+			elif os.path.exists(sidecar):
+				os.remove(sidecar)
+			plr = make_plr(printer, {'resume_mode': mode,
+									 'restart_gcode': '_PLR_RESUME_PRINT_START'})
+			def prepare():
+				if mode == 'virtual':
+					result = plr._build_virtual_prologue(path, file_position, 12.4)
+				else:
+					result = plr._write_resume_file(path, file_position, 12.4)
+				if result is None:
+					raise RuntimeError(f"{mode} resume preparation failed")
+				if mode == 'copy':
+					os.remove(result)
+				return result
+			label = f"resume_{mode}" + ("_indexed" if use_index else "")
+			report(label, timed(prepare, repeat))
+
+	# Time the periodic save path: state selection, verification and the
+	# hand-off to the writer thread until the variables file is replaced
+	plr = make_plr(printer, {'track_executed_position': False})
+	plr.is_active = True
+	plr.power_loss_recovery_enabled = True
+	plr.state_history.extend(dict(state) for _ in range(plr.save_delay + 1))
+	plr.state_writer = power_loss_recovery.StateWriter(
+		variables_file, plr._snapshot_variables, plr.save_stats)
+	plr.state_writer.start()
+	def save_state():
+		write_count = plr.state_writer.get_stats()['write_count']
+		plr._save_current_state('manual')
+		while plr.state_writer.get_stats()['write_count'] == write_count:
+			time.sleep(0.0001)
+		if plr.state_writer.get_stats()['error_count']:
+			raise RuntimeError(plr.state_writer.get_stats()['last_error'])
+	try:
+		measurement = timed(save_state, repeat * 10)
+	finally:
+		plr.state_writer.stop()
+	report('state_save', measurement, os.path.getsize(variables_file))
+
+	for leftover in (path, power_loss_recovery.GCodeLayerIndex.sidecar_path(path)):
+		if os.path.exists(leftover):
+			os.remove(leftover)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Benchmark PLR resume preparation, md5 check and state saving")
+	parser.add_argument('--size-mb', type=int, default=50, help="Size of each G-code file")
+	parser.add_argument('--layers', type=int, default=500, help="Layer count of each G-code file")
+	parser.add_argument('--styles', default=",".join(STYLES),
+						help="Comma separated slicer styles (prusa, orca, cura)")
+	parser.add_argument('--repeat', type=int, default=3, help="Runs per benchmark, the best is reported")
+	parser.add_argument('--dir', help="Work directory (default: temporary directory)")
+	parser.add_argument('--seed', type=int, default=1)
+	args = parser.parse_args()
+
+	random.seed(args.seed)
+	styles = [s.strip() for s in args.styles.split(',') if s.strip()]
+	for style in styles:
+		if style not in STYLES:
+			parser.error(f"Unknown style: {style}")
+
+	workdir = args.dir or tempfile.mkdtemp(prefix='plr_bench_')
+	os.makedirs(workdir, exist_ok=True)
+	try:
+		print(f"{'style':<6} {'benchmark':<24} {'time (s)':>10} {'MB/s':>10} {'peak alloc (MB)':>16}")
+		for style in styles:
+			for style, name, duration, rate, peak in run_benchmarks(
+					workdir, style, args.size_mb, args.layers, args.repeat):
+				rate = "-" if rate is None else f"{rate:.1f}"
+				print(f"{style:<6} {name:<24} {duration:>10.4f} {rate:>10} {peak:>16.2f}")
+	finally:
+		if not args.dir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+	main()
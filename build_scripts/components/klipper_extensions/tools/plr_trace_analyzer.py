@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Offline analyzer for PLR_Z_HOME probe traces
+#
+# Reads the JSON lines written by power_loss_recovery when probe_trace_file
+# is set, summarizes time and repeatability of the recorded runs and
+# predicts both for alternative speed, retract and sample settings
+# without probing on the printer again.
+#
+# Model: a probing move takes its distance / speed plus the fixed overhead
+# seen in the trace. Search moves keep their distance, sample and final
+# moves start retract distance below the endstop. Trigger scatter comes
+# from the endstop sampling time, so the sample spread scales with the
+# slow homing speed.
+#
+# Usage: plr_trace_analyzer.py TRACE [--mode CALIBRATE] [--last 10]
+#        [--slow-homing-speed 1.5] [--sample-size 5] ...
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import argparse
+import json
+import statistics
+import sys
+
+# Settings that can be simulated and their type
+SETTINGS = {
+	'fast_move_speed': float,
+	'slow_homing_speed': float,
+	'retract_dist': float,
+	'sample_retract_dist': float,
+	'sample_size': int,
+}
+
+def load_runs(filename, mode=None):
+	runs = []
+	with open(filename) as f:
+		for lineno, line in enumerate(f, 1):
+			line = line.strip()
+			if not line:
+				continue
+			try:
+				run = json.loads(line)
+			except ValueError:
+				print(f"{filename}:{lineno}: skipping invalid line", file=sys.stderr)
+				continue
+			if mode and run.get('mode') != mode:
+				continue
+			runs.append(run)
+	return runs
+
+def probe_role(event, settings):
+	"""search: distance set by geometry, sample/return: set by a retract distance"""
+	phase = event.get('phase')
+	if phase == 'final_home':
+		return 'return'
+	if phase in ('stepper_probing', 'iterations'):
+		if event['speed'] == settings['slow_homing_speed']:
+			return 'sample'
+		return 'return'
+	return 'search'
+
+def probe_distance(event):
+	if 'trigger_z' in event:
+		return abs(event['trigger_z'] - event['start_z'])
+	return abs(event['target_z'] - event['start_z'])
+
+def predict_probe(event, settings, new):
+	"""Predicted duration of a recorded probing move with the new settings"""
+	role = probe_role(event, settings)
+	distance = probe_distance(event)
+	speed = event['speed']
+	overhead = max(event['duration'] - distance / speed, 0.)
+	if role == 'sample':
+		distance += new['sample_retract_dist'] - settings['sample_retract_dist']
+		new_speed = new['slow_homing_speed']
+	elif role == 'return':
+		distance += new['retract_dist'] - settings['retract_dist']
+		new_speed = (new['slow_homing_speed'] if speed == settings['slow_homing_speed']
+					 else new['fast_move_speed'])
+	else:
+		new_speed = (new['slow_homing_speed'] if speed == settings['slow_homing_speed']
+					 else new['fast_move_speed'])
+	return max(distance, 0.) / new_speed + overhead
+
+def stepper_samples(run):
+	samples = {}
+	for event in run['events']:
+		if event['kind'] == 'sample':
+			samples.setdefault(event['name'], []).append(event['value'])
+	return samples
+
+def spread(values):
+	if len(values) < 2:
+		return 0.
+	return statistics.stdev(values)
+
+def simulate(run, new):
+	"""Returns (predicted_total, {stepper: predicted_sample_stdev})"""
+	settings = run['settings']
+	events = run['events']
+	total = run.get('total', 0.)
+
+	# Probing moves
+	sample_cycles = []
+	for event in events:
+		if event['kind'] != 'probe':
+			continue
+		predicted = predict_probe(event, settings, new)
+		total += predicted - event['duration']
+		if probe_role(event, settings) == 'sample':
+			# A sample also needs the slow retract move before it
+			old_retract = settings['sample_retract_dist'] / settings['slow_homing_speed']
+			new_retract = new['sample_retract_dist'] / new['slow_homing_speed']
+			total += new_retract - old_retract
+			sample_cycles.append(predicted + new_retract)
+
+	# More or fewer samples per stepper, only fixed sampling takes sample_size
+	samples = stepper_samples(run)
+	if sample_cycles and settings.get('sampling_mode', 'fixed') == 'fixed':
+		cycle = statistics.mean(sample_cycles)
+		# Simultaneous probing samples all steppers with one move
+		moves_per_sample = 1
+		if settings.get('stepper_probing') != 'simultaneous':
+			moves_per_sample = len(settings.get('steppers', samples))
+		passes = 1
+		iterations = settings.get('probe_iteration_count', 0)
+		if run.get('mode') == 'CALIBRATE' and iterations > 1:
+			passes += iterations
+		total += (new['sample_size'] - settings['sample_size']) * cycle * moves_per_sample * passes
+
+	scale = new['slow_homing_speed'] / settings['slow_homing_speed']
+	predicted_spread = {name: spread(values) * scale for name, values in samples.items()}
+	return max(total, 0.), predicted_spread
+
+def summarize(run):
+	events = run['events']
+	probes = [e for e in events if e['kind'] == 'probe']
+	retries = sum(e.get('count', 1) for e in events if e['kind'] == 'retry')
+	settle = sum(e['duration'] for e in events if e['kind'] == 'settle')
+	return {
+		'total': run.get('total', 0.),
+		'probes': len(probes),
+		'probe_time': sum(e['duration'] for e in probes),
+		'settle_time': settle,
+		'retries': retries,
+		'error': run.get('error'),
+	}
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Summarize PLR_Z_HOME probe traces and predict other settings")
+	parser.add_argument('trace', help="probe_trace_file written by power_loss_recovery")
+	parser.add_argument('--mode', choices=('CALIBRATE', 'RESUME'), help="Only use runs of this mode")
+	parser.add_argument('--last', type=int, default=0, help="Only use the last N runs")
+	for name, kind in SETTINGS.items():
+		parser.add_argument('--' + name.replace('_', '-'), type=kind, help="Simulated value")
+	args = parser.parse_args()
+
+	runs = load_runs(args.trace, args.mode)
+	if args.last:
+		runs = runs[-args.last:]
+	if not runs:
+		parser.error("No matching runs in trace")
+
+	print(f"{'run':<4} {'mode':<10} {'total (s)':>10} {'probes':>7} {'probe (s)':>10} "
+		  f"{'settle (s)':>11} {'retries':>8} {'predicted (s)':>14}")
+	predicted_totals = []
+	recorded_spread = {}
+	predicted_spread = {}
+	offsets = {}
+	for i, run in enumerate(runs):
+		new = {name: getattr(args, name) if getattr(args, name) is not None
+			   else run['settings'][name] for name in SETTINGS}
+		summary = summarize(run)
+		predicted, spreads = simulate(run, new)
+		predicted_totals.append(predicted)
+		for name, values in stepper_samples(run).items():
+			recorded_spread.setdefault(name, []).append(spread(values))
+		for name, value in spreads.items():
+			predicted_spread.setdefault(name, []).append(value)
+		for name, value in (run.get('offsets') or {}).items():
+			offsets.setdefault(name, []).append(value)
+		error = f"  error: {summary['error']}" if summary['error'] else ""
+		print(f"{i:<4} {run.get('mode', '?'):<10} {summary['total']:>10.2f} {summary['probes']:>7} "
+			  f"{summary['probe_time']:>10.2f} {summary['settle_time']:>11.2f} "
+			  f"{summary['retries']:>8} {predicted:>14.2f}{error}")
+
+	totals = [run.get('total', 0.) for run in runs]
+	print(f"\nMean homing time: recorded {statistics.mean(totals):.2f}s, "
+		  f"predicted {statistics.mean(predicted_totals):.2f}s")
+	if recorded_spread:
+		print(f"\n{'stepper':<12} {'sample stdev (mm)':>18} {'predicted (mm)':>15} {'offset stdev (mm)':>18}")
+		for name in sorted(recorded_spread):
+			offset_spread = spread(offsets.get(name, []))
+			print(f"{name:<12} {statistics.mean(recorded_spread[name]):>18.4f} "
+				  f"{statistics.mean(predicted_spread[name]):>15.4f} {offset_spread:>18.4f}")
+
+if __name__ == '__main__':
+	main()